@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+import getopt
+import json
+import logging
+import os
+import os.path
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import dbminer
+
+#-----------------------------------------------------------------------------
+# Configuration and Globals
+# {{{
+
+MINER = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dbminer.py')]
+
+DEFAULT_FILES = [1000]
+DEFAULT_PATTERNS = [100, 10000]
+SEED = 4711
+
+# words of the synthetic texts and titles
+VOCABULARY_SIZE = 20000
+# words per synthetic text, drawn uniformly
+TEXT_WORDS = (500, 5000)
+# how many pattern titles a text mentions, drawn uniformly
+TEXT_MENTIONS = (0, 3)
+# texts mention titles up to this number, the smaller the more often; a
+# pattern DB of n entries has the titles 0..n-1
+TITLE_UNIVERSE = 100000
+
+OAI_TEMPLATE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<record xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<metadata>
+<dc:title>%(title)s</dc:title>
+%(creators)s
+%(subjects)s
+<dc:description>%(description)s</dc:description>
+<dc:language>%(language)s</dc:language>
+<dc:identifier>http://bench.example.org/publication/%(number)d</dc:identifier>
+</metadata>
+</record>
+"""
+
+SOLR_DOC_TEMPLATE = u"""<doc><str name="id">%(number)d</str><arr name="title"><str>%(title)s</str></arr>\
+<arr name="subject">%(subjects)s</arr><arr name="person">%(persons)s</arr>\
+<arr name="doi"><str>10.9999/bench.%(number)d</str></arr>\
+<arr name="studyLanguage_txt"><str>%(language)s</str></arr></doc>
+"""
+
+#
+# }}}
+#-----------------------------------------------------------------------------
+
+#-----------------------------------------------------------------------------
+# Synthetic data
+#{{{
+
+def vocabulary():
+    """
+    The words all synthetic data is made of, the same for every seed
+    """
+    rng = random.Random(SEED)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(letters) for x in range(rng.randint(2, 12))))
+    return sorted(words)
+
+def words_of(rng, words, n):
+    # a rough Zipf distribution: early words are much more frequent
+    return [words[int(len(words) * rng.random() ** 3)] for x in range(n)]
+
+def title(words, number):
+    """
+    The title of the `number`th synthetic dataset, like da-ra titles: a few
+    words, some with a year range that `make_pattern` strips
+    """
+    rng = random.Random(SEED * 31 + number)
+    result = ' '.join(w.capitalize() for w in words_of(rng, words, rng.randint(2, 6)))
+    if number % 4 == 0:
+        result += ', %d-%d' % (1950 + number % 60, 1951 + number % 60)
+    return result
+
+def generate_corpus(datadir, nfiles, words):
+    """
+    Write `nfiles` texts to `datadir`/text/all and their OAI-PMH metadata
+    to `datadir`/meta
+    """
+    textdir = os.path.join(datadir, 'text', 'all')
+    metadir = os.path.join(datadir, 'meta')
+    for d in [textdir, metadir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    rng = random.Random(SEED + nfiles)
+    for number in range(nfiles):
+        text = words_of(rng, words, rng.randint(*TEXT_WORDS))
+        for x in range(rng.randint(*TEXT_MENTIONS)):
+            mention = int(TITLE_UNIVERSE * rng.random() ** 4)
+            text.insert(rng.randint(0, len(text)), title(words, mention))
+        name = 'oai_%d' % number
+        with open(os.path.join(textdir, name + '.txt'), 'w') as textout:
+            textout.write(' '.join(text))
+        with open(os.path.join(metadir, name + '.xml'), 'w') as metaout:
+            metaout.write((OAI_TEMPLATE % {
+                'number': number,
+                'title': ' '.join(words_of(rng, words, 8)).capitalize(),
+                'creators': "\n".join('<dc:creator>%s</dc:creator>' % w for w in words_of(rng, words, 3)),
+                'subjects': "\n".join('<dc:subject>%s</dc:subject>' % w for w in words_of(rng, words, 4)),
+                'description': ' '.join(words_of(rng, words, 100)),
+                'language': rng.choice(['eng', 'ger']),
+            }).encode('utf-8'))
+
+def generate_patterns(dbfile, solrfile, npatterns, words):
+    """
+    Write a pattern DB of `npatterns` da-ra-like entities shaped like the
+    output of `make_pattern`, and the solr XML they would be imported from
+    """
+    rng = random.Random(SEED + npatterns)
+    db = {'entity': {}, 'infolisPattern': {}, 'entityLink': {}}
+    with open(solrfile, 'w') as solrout:
+        solrout.write('<?xml version="1.0" encoding="UTF-8"?>\n<response>\n<result name="response">\n')
+        for number in range(npatterns):
+            entity = {
+                '_id': 'daradoc_%d' % number,
+                'entityType': 'dataset',
+                'name': title(words, number),
+                'authors': words_of(rng, words, 3),
+                'subjects': words_of(rng, words, 4),
+                'language': 'eng',
+            }
+            db['entity'][entity['_id']] = entity
+            dbminer.make_pattern(db, 'darapat', entity['name'], entity['_id'])
+            solrout.write((SOLR_DOC_TEMPLATE % {
+                'number': number,
+                'title': entity['name'],
+                'subjects': ''.join('<str>%s</str>' % w for w in entity['subjects']),
+                'persons': ''.join('<str>%s</str>' % w for w in entity['authors']),
+                'language': entity['language'],
+            }).encode('utf-8'))
+        solrout.write('</result>\n</response>\n')
+    with open(dbfile, 'w') as dbout:
+        json.dump(db, dbout, indent=2)
+    return len(db['infolisPattern'])
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Running
+#{{{
+
+def output_size(path):
+    """
+    Size of the file `path` plus any sidecar files next to it
+    """
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path)
+    return sum(os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory) if name.startswith(prefix))
+
+def run_case(name, args, output, files=0, patterns=0):
+    """
+    Run one dbminer.py command and measure it
+    """
+    logging.info("Running %s: %s" % (name, ' '.join(args)))
+    with open(os.devnull, 'w') as devnull:
+        t0 = time.time()
+        proc = subprocess.Popen(MINER + args, stdout=devnull, stderr=devnull)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.time() - t0
+    if status != 0:
+        raise RuntimeError("%s failed with status %d" % (name, status))
+    result = {
+        'name': name,
+        'command': args,
+        'wall': wall,
+        'cpu': rusage.ru_utime + rusage.ru_stime,
+        # kilobytes on Linux, bytes on OS X
+        'maxrss': rusage.ru_maxrss,
+        'output_bytes': output_size(output),
+        'files': files,
+        'patterns': patterns,
+        'files_per_s': files / wall,
+        'patterns_per_s': patterns / wall,
+    }
+    logging.info("%s: %.2fs wall, %.2fs cpu, %d maxrss" % (name, wall, result['cpu'], result['maxrss']))
+    return result
+
+def run(datadir, resultsfile, nfiles_list, npatterns_list, jobs):
+    words = vocabulary()
+    results = []
+    outdir = os.path.join(datadir, 'out')
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    dbfiles = {}
+    for npatterns in npatterns_list:
+        dbfile = os.path.join(datadir, 'patterns-%d.json' % npatterns)
+        solrfile = os.path.join(datadir, 'solr-%d.xml' % npatterns)
+        if not os.path.exists(dbfile):
+            logging.info("Generating %d patterns" % npatterns)
+            generate_patterns(dbfile, solrfile, npatterns, words)
+        dbfiles[npatterns] = dbfile
+        out = os.path.join(outdir, 'dara-%d.json' % npatterns)
+        results.append(run_case('jsonify-dara/%d' % npatterns,
+            ['jsonify-dara', '--jobs', str(jobs), solrfile, out], out, patterns=npatterns))
+        out = os.path.join(outdir, 'patterns-%d.idx' % npatterns)
+        results.append(run_case('compile-patterns/%d' % npatterns,
+            ['compile-patterns', dbfile, out], out, patterns=npatterns))
+    for nfiles in nfiles_list:
+        corpusdir = os.path.join(datadir, 'corpus-%d' % nfiles)
+        if not os.path.isdir(corpusdir):
+            logging.info("Generating %d files" % nfiles)
+            generate_corpus(corpusdir, nfiles, words)
+        textdir = os.path.join(corpusdir, 'text', 'all')
+        metadir = os.path.join(corpusdir, 'meta')
+        outs = []
+        for npatterns in npatterns_list:
+            out = os.path.join(outdir, 'search-%d-%d.json' % (nfiles, npatterns))
+            outs.append(out)
+            results.append(run_case('search-patterns/%d/%d' % (nfiles, npatterns),
+                ['search-patterns', '--jobs', str(jobs),
+                    os.path.join(outdir, 'patterns-%d.idx' % npatterns), textdir, metadir, out],
+                out, files=nfiles, patterns=npatterns))
+        out = os.path.join(outdir, 'merge-%d.json' % nfiles)
+        results.append(run_case('merge-json/%d' % nfiles,
+            ['merge-json', '--jobs', str(jobs), out, dbfiles[max(npatterns_list)]] + outs,
+            out, files=nfiles, patterns=max(npatterns_list)))
+    with open(resultsfile, 'w') as resultsout:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'jobs': jobs,
+            'results': results,
+        }, resultsout, indent=2, sort_keys=True)
+
+def compare(oldfile, newfile):
+    """
+    Print how the results in `newfile` differ from those in `oldfile`
+    """
+    with open(oldfile) as oldin:
+        old = dict((r['name'], r) for r in json.load(oldin)['results'])
+    with open(newfile) as newin:
+        new = json.load(newin)['results']
+    print("%-30s %10s %10s %7s %10s %10s %7s" % (
+        'case', 'old wall', 'new wall', 'ratio', 'old rss', 'new rss', 'ratio'))
+    for result in new:
+        if result['name'] not in old:
+            continue
+        before = old[result['name']]
+        print("%-30s %10.2f %10.2f %7.2f %10d %10d %7.2f" % (
+            result['name'],
+            before['wall'], result['wall'], result['wall'] / max(before['wall'], 1e-9),
+            before['maxrss'], result['maxrss'], result['maxrss'] * 1.0 / max(before['maxrss'], 1)))
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Main
+#{{{
+
+def print_usage(exit_code):
+    prog = sys.argv[0]
+    print("Usage: " + prog + " <command> [args...]")
+    print("""
+    Commands:
+
+    run [options] <datadir> <results-json>
+        Generate synthetic corpora and pattern DBs in <datadir>
+        (unless they are there already), time the dbminer.py
+        commands on them and write the measurements to
+        <results-json>
+
+        --files N,...       Corpus sizes (default: 1000)
+        --patterns N,...    Pattern DB sizes (default: 100,10000)
+        --jobs N            Worker processes for the commands that
+                            have them (default: 1)
+
+    compare <old-results-json> <new-results-json>
+        Compare the measurements of two runs
+    """)
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] == '-h' or sys.argv[1] == '--help':
+        print_usage(0)
+    cmd = sys.argv[1]
+    if cmd == 'run':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['files=', 'patterns=', 'jobs='])
+            opts = dict(opts)
+            nfiles_list = [int(n) for n in opts.get('--files', '').split(',') if n] or DEFAULT_FILES
+            npatterns_list = [int(n) for n in opts.get('--patterns', '').split(',') if n] or DEFAULT_PATTERNS
+            jobs = int(opts.get('--jobs', 1))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 2:
+            print_usage(1)
+        run(args[0], args[1], nfiles_list, npatterns_list, jobs)
+    elif cmd == 'compare':
+        if len(sys.argv) != 4:
+            print_usage(1)
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        print_usage(1)
+#}}}
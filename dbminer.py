@@ -1,18 +1,41 @@
 #!/usr/bin/env python
 
+from collections import Counter, OrderedDict, deque
 from hashlib import md5
+import array
+import BaseHTTPServer
+import bisect
+import cPickle
 import csv
+import gc
 import glob
+import gzip
+import heapq
+import httplib
 import io
 import itertools
 import json
+import getopt
 import logging
+import marshal
+import mmap
+import multiprocessing
 import os.path
+import Queue
 import re
 import resource
-import subprocess
+import shutil
+import socket
+import SocketServer
+import string
+import struct
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+import urlparse
+import zipfile
 try:
     import lxml.etree as ET
 except ImportError:
@@ -20,6 +43,14 @@ except ImportError:
         import xml.etree.cElementTree as ET
     except ImportError:
         import xml.etree.ElementTree as ET
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #-----------------------------------------------------------------------------
 # Configuration and Globals
@@ -29,9 +60,106 @@ logging.basicConfig(level=logging.DEBUG,
     format='[%(levelname)s] %(asctime)s.%(msecs)03d - %(message)s',
     datefmt='%H:%M:%S')
 
-# save intermediate results every n files
+# write the run manifest every n files
 BAK_INTERVAL = 500
 
+# search-patterns --jobs: chunks of text files handed out per worker process
+CHUNKS_PER_JOB = 8
+
+# jsonify-dara --jobs: <doc> elements handed out to a worker process at once
+SOLR_DOCS_PER_BATCH = 200
+
+# first bytes of a pattern index written by compile-patterns
+PATTERN_INDEX_MAGIC = 'DBMINER-PATTERN-INDEX 4\n'
+
+# merge-json: entries per sorted run written to disk
+MERGE_RUN_SIZE = 100000
+
+# first bytes of a packed corpus index written by pack-corpus
+PACKED_CORPUS_MAGIC = 'DBMINER-PACKED-CORPUS 1\n'
+
+# text and metadata sources that are read as archives, see Archive
+ARCHIVE_RE = re.compile(r"\.(tar|tar\.gz|tgz|tar\.bz2|zip|gz)$")
+
+# compressed archives: bytes of the members passed over kept for later reads
+ARCHIVE_SKIPPED_BYTES = 64 << 20
+
+# first bytes of a keyed store index, see KeyedStore
+KEYED_STORE_MAGIC = 'DBMINER-KEYED-STORE 1\n'
+
+# first bytes of the file list of a corpus index written by index-corpus
+CORPUS_INDEX_MAGIC = 'DBMINER-CORPUS-INDEX 1\n'
+
+# index-corpus: token occurrences per sorted run written to disk
+INDEX_RUN_POSTINGS = 5000000
+
+# query-patterns: bytes of stored postings kept in memory between phrases
+POSTINGS_CACHE_BYTES = 32 << 20
+
+# what a search worker process needs, set before the pool is forked
+WORKER_STATE = {}
+
+# search-patterns --prefetch: files loaded ahead per reader thread, unless
+# --queue-depth is given
+PREFETCH_DEPTH_PER_THREAD = 4
+
+# serve: where the HTTP server listens unless told otherwise
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8765
+
+# seconds between two progress reports on stderr
+PROGRESS_INTERVAL = 0.5
+
+# search-patterns: files larger than this are searched in windows of this
+# many bytes while they are read, instead of being read whole
+TEXT_WINDOW_BYTES = 16 << 20
+
+# least overlap of two windows, for regexes to match across their border
+WINDOW_MIN_OVERLAP = 4096
+
+# search-patterns --max-file-seconds: bytes scanned for keywords between two
+# looks at the clock
+SCAN_BLOCK_BYTES = 256 << 10
+
+# search-patterns --max-file-size/--max-file-seconds: files larger or
+# slower to search are skipped, 0 for no limit
+FILE_BUDGET = {'bytes': 0, 'seconds': 0}
+
+# harvest: where the pages of each source are downloaded from, {start} and
+# {rows} are replaced by the first record and the number of records of a page
+DARA_SOLR_URL = 'http://www.da-ra.de/solr/dara/select?q=resourceType:2&start={start}&rows={rows}'
+ICPSR_STUDIES_URL = ('http://www.icpsr.umich.edu/icpsrweb/ICPSR/csv/studies'
+    '?collection=DATA&paging.startRow={start}&paging.rows={rows}&archive=ICPSR')
+
+# harvest: records per page and pages downloaded at once
+HARVEST_ROWS = 1000
+HARVEST_THREADS = 2
+
+# harvest, upload: tries per request, seconds to wait before the first
+# retry (doubled for every further one) and seconds to wait for a response
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 1.0
+HTTP_TIMEOUT = 60
+
+# upload: where batches are POSTed to, entries per batch, batches sent at
+# once and the sections of the db uploaded
+UPLOAD_URL = 'http://localhost:3000/api/json-import'
+UPLOAD_BATCH_SIZE = 1000
+UPLOAD_THREADS = 4
+UPLOAD_SECTIONS = ('entity', 'entityLink')
+
+# --metrics: how many of the slowest files to report
+SLOWEST_FILES = 20
+
+# summarize: length of the top patterns and top targets lists
+SUMMARY_TOP = 20
+
+# summarize: confidence histogram bins per unit, 1.0 gets a bin of its own
+CONFIDENCE_BINS = 10
+
+# summarize: the corpus of the links of an output without a summary
+UNKNOWN_CORPUS = 'unknown'
+
 DATABASES_CSV_HEADER = { "ID": 0, "TITLE": 1, "KEYWORDS": 2, 'URL': 3 }
 
 ICPSRSTUDIES_CSV_HEADER = {
@@ -50,6 +178,8 @@ ENTITY_CONFIDENCE = 0.97
 ENTITY_RELATIONS = ['uses_database']
 ENTITYT_LINKREASON = 'dbminer'
 
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
 CLEAR = "\r"
 for x in range(0,100):
     CLEAR+=' '
@@ -57,6 +187,19 @@ CLEAR += '\r'
 
 xmlnode_text = lambda (x) : x.text
 urlescape = lambda (x) : re.sub("[^a-zA-Z0-9]", "", re.sub("^https?://", '', x.lower()))
+regexify = lambda (x) : "\\b" + re.escape(x) + "\\b"
+
+# Characters `\b` treats as part of a word. Patterns are compiled without
+# re.UNICODE, so this is ASCII only, for str and unicode input alike.
+WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+# the words between two such boundaries, as index-corpus indexes them
+TOKEN_RE = re.compile(r'\w+')
+
+# start and end tags of a <doc> in a solr XML response, which may have
+# attributes or whitespace
+SOLR_DOC_START_RE = re.compile(r'<doc[\s>]')
+SOLR_DOC_END_RE = re.compile(r'</doc\s*>')
 
 RE_CACHE = {}
 def cachedRegex(r):
@@ -66,42 +209,214 @@ def cachedRegex(r):
 
 def print_progress(cur, total, found, t0, idstr):
     """
-    Show informative progress report on STDERR
+    Show informative progress report on STDERR, at most every
+    PROGRESS_INTERVAL seconds and once the last item is done
     """
-    if cur <= 1 or cur % 10 == 0:
-        try:
-            print_progress.throughput = cur / (time.time() - t0)
-        except AttributeErrror, e:
-            print_progress.throughput = 1
-        try:
-            seconds = (total - cur) / print_progress.throughput
-            m, s = divmod(seconds, 60)
-            h, m = divmod(m, 60)
-            print_progress.eta = "%d:%02d:%02d" % (h, m, s)
-        except AttributeErrror, e:
-            print_progress.eta = "---"
+    now = time.time()
+    if cur < total and now - getattr(print_progress, 'last', 0) < PROGRESS_INTERVAL:
+        return
+    print_progress.last = now
+    try:
+        throughput = cur / (now - t0)
+    except ZeroDivisionError, e:
+        throughput = 0
+    try:
+        seconds = (total - cur) / throughput
+        m, s = divmod(seconds, 60)
+        h, m = divmod(m, 60)
+        eta = "%d:%02d:%02d" % (h, m, s)
+    except ZeroDivisionError, e:
+        eta = "---"
     #  sys.stderr.write("\r[%-2.2f%%] %-5d/%5d [found: %4d] [throughput: %4.3f/s] [ETA: %s]"%(
     sys.stderr.write("\r[%10s][%-2.2f%%] %-5d/%5d [found: %4d] [throughput: %4.3f/s] [ETA: %s]"%(
         idstr,
-        (cur * 1.0/total*100),
+        (cur * 100.0 / max(1, total)),
         cur,
         total,
         found,
-        print_progress.throughput,
-        print_progress.eta,
+        throughput,
+        eta,
         ))
 
 #
 # }}}
 #-----------------------------------------------------------------------------
 
+#-----------------------------------------------------------------------------
+# Instrumentation
+#{{{
+
+def cpu_time():
+    """
+    User and system CPU seconds of this process so far
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class NoStage(object):
+    """
+    What `Metrics.stage` returns while metrics are disabled
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_STAGE = NoStage()
+
+class MetricsStage(object):
+    """
+    Adds the wall and CPU time of a `with` block to a stage of `metrics`
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_stage(self.name, time.time() - self.wall, cpu_time() - self.cpu)
+
+class Metrics(object):
+    """
+    Wall and CPU time per stage, per-pattern candidate and confirmed hit
+    counts and the slowest files of a run. Collects nothing until enabled
+    by --metrics.
+
+    Worker processes collect into their own copy, see `state` and `merge`,
+    so the stage times of a run with --jobs are summed over all processes.
+    Stages run by --prefetch reader threads count the CPU time of the whole
+    process.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        # pattern indexes are reported as these ids, if set
+        self.pattern_ids = None
+        self.reset()
+
+    def reset(self):
+        # name: [wall, cpu, count]
+        self.stages = {}
+        self.candidates = {}
+        self.confirmed = {}
+        # heap of (seconds, file)
+        self.slowest = []
+
+    def enable(self):
+        self.enabled = True
+        self.t0 = time.time()
+
+    def stage(self, name):
+        """
+        A context manager that times its block as stage `name`
+        """
+        if not self.enabled:
+            return NO_STAGE
+        return MetricsStage(self, name)
+
+    def iter_stage(self, name, iterable):
+        """
+        Yield from `iterable`, timing the wait for each item as stage `name`
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_stage(self, name, wall, cpu, count=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += count
+
+    def count_patterns(self, candidates, confirmed):
+        """
+        Count the patterns the prefilter found `candidates` and those of
+        them that were `confirmed`
+        """
+        for idx in candidates:
+            self.candidates[idx] = self.candidates.get(idx, 0) + 1
+        for idx in confirmed:
+            self.confirmed[idx] = self.confirmed.get(idx, 0) + 1
+
+    def add_file(self, textfile, seconds):
+        if len(self.slowest) < SLOWEST_FILES:
+            heapq.heappush(self.slowest, (seconds, textfile))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, textfile))
+
+    def state(self):
+        """
+        What was collected, to be merged into the parent process's metrics
+        """
+        return self.stages, self.candidates, self.confirmed, self.slowest
+
+    def merge(self, state):
+        stages, candidates, confirmed, slowest = state
+        for name, (wall, cpu, count) in stages.iteritems():
+            self.add_stage(name, wall, cpu, count)
+        for counts, more in [(self.candidates, candidates), (self.confirmed, confirmed)]:
+            for idx, n in more.iteritems():
+                counts[idx] = counts.get(idx, 0) + n
+        for seconds, textfile in slowest:
+            self.add_file(textfile, seconds)
+
+    def save(self, path):
+        """
+        Write everything collected and the totals of the run as JSON
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        pattern_id = lambda idx: self.pattern_ids[idx] if self.pattern_ids else idx
+        result = {
+            'command': sys.argv[1:],
+            'wall': time.time() - self.t0,
+            'cpu': {
+                'self': usage.ru_utime + usage.ru_stime,
+                'children': children.ru_utime + children.ru_stime,
+            },
+            # kilobytes on Linux, bytes on OS X
+            'maxrss': {
+                'self': usage.ru_maxrss,
+                'children': children.ru_maxrss,
+            },
+            'stages': dict((name, {'wall': wall, 'cpu': cpu, 'count': count})
+                for name, (wall, cpu, count) in self.stages.iteritems()),
+            'patterns': dict((pattern_id(idx), {
+                    'candidates': n,
+                    'confirmed': self.confirmed.get(idx, 0),
+                }) for idx, n in self.candidates.iteritems()),
+            'slowest_files': [{'file': textfile, 'seconds': seconds}
+                for seconds, textfile in sorted(self.slowest, reverse=True)],
+        }
+        with open(path, 'w') as metricsout:
+            json.dump(result, metricsout, indent=2, sort_keys=True)
+
+METRICS = Metrics()
+
+#}}}
+
 #-----------------------------------------------------------------------------
 # Generating objects
 #{{{
 
-def make_infolis_file_from_textfile(textfile, entity):
+def make_infolis_file(textfile, entity, digest):
     """
-    Create an InfolisFile from a text file and the entity it manifests
+    Create an InfolisFile for a text file with md5 `digest` and the entity
+    it manifests
     """
     infolis_file = {}
     p, basename = os.path.split(textfile)
@@ -111,12 +426,87 @@ def make_infolis_file_from_textfile(textfile, entity):
     infolis_file['fileStatus'] = 'AVAILABLE'
     infolis_file['mediaType'] = 'text/plain'
     infolis_file['fileName'] = basename
-    with open(textfile, 'r') as textin:
-        textcontents = textin.read()
-        infolis_file['md5'] = md5(textcontents).hexdigest()
-        textcontents = textcontents.decode('utf-8')
+    infolis_file['md5'] = digest
     infolis_file['manifestsEntity'] = entity['_id']
-    return infolis_file, textcontents
+    return infolis_file
+
+def read_textfile(textfile):
+    """
+    The contents of a text file, undecoded, and their md5
+    """
+    with METRICS.stage('read'):
+        with open(textfile, 'r') as textin:
+            textcontents = textin.read()
+    with METRICS.stage('md5'):
+        digest = md5(textcontents).hexdigest()
+    return textcontents, digest
+
+class FileBudgetError(Exception):
+    pass
+
+def check_deadline(deadline):
+    """
+    Raise FileBudgetError if there is a `deadline` and it has passed
+    """
+    if deadline and time.time() > deadline:
+        raise FileBudgetError("still searching after %g seconds" % FILE_BUDGET['seconds'])
+
+def utf8_boundary(data, pos):
+    """
+    Where the UTF-8 character that `data[pos]` belongs to starts
+    """
+    while 0 < pos < len(data) and '\x80' <= data[pos] < '\xc0':
+        pos -= 1
+    return pos
+
+def utf8_length(lead):
+    """
+    The length of the UTF-8 character that starts with the byte `lead`
+    """
+    if lead < '\xc0':
+        return 1
+    if lead < '\xe0':
+        return 2
+    if lead < '\xf0':
+        return 3
+    return 4
+
+def iter_windows(textin, digest, overlap, size=TEXT_WINDOW_BYTES):
+    """
+    Read `textin` in blocks of `size` bytes, updating `digest` with them,
+    and yield (window, start, last) for each: `window` is the block after
+    at least the last `overlap` bytes of the window before, `start` where
+    the block begins in it, `last` whether it is the last. Windows begin
+    and end on UTF-8 character boundaries.
+    """
+    def read():
+        with METRICS.stage('read'):
+            block = textin.read(size)
+        with METRICS.stage('md5'):
+            digest.update(block)
+        return block
+    block = read()
+    tail = ''
+    while True:
+        next_block = read()
+        if next_block:
+            # a character cut in two goes with the next block
+            lead = utf8_boundary(block, len(block) - 1)
+            if lead + utf8_length(block[lead]) > len(block):
+                block, next_block = block[:lead], block[lead:] + next_block
+        window = tail + block
+        yield window, len(tail), not next_block
+        if not next_block:
+            return
+        tail = window[utf8_boundary(window, max(0, len(window) - overlap)):]
+        block = next_block
+
+def make_infolis_file_from_textfile(textfile, entity):
+    """
+    Create an InfolisFile from a text file and the entity it manifests
+    """
+    textcontents, digest = read_textfile(textfile)
+    return make_infolis_file(textfile, entity, digest), textcontents.decode('utf-8')
 
 def make_entity_from_oai(metafile):
     """
@@ -163,7 +553,7 @@ def make_entity_from_solr_doc(db, elem):
                 'test',
                 'readme',
                 'tourismus',
-                'sportvereine'j,
+                'sportvereine',
                 'rezension',
                 'contents',
                 'budget'] \
@@ -181,23 +571,32 @@ def make_entity_from_solr_doc(db, elem):
         entity['language'] = 'eng'
     return entity
 
-def make_entity_link_from_pattern(indb, from_id, pat_id, outdb):
+def make_entity_link_from_pattern(matcher, entity, pat_idx, outdb, escaped_from_id=None, links=None):
     """
     Create a link from an entity to another entity because of pattern
+
+    `escaped_from_id` is `urlescape` of the entity's id, if known already.
+    The links are also put into the dict `links`, if given.
     """
-    infolisPattern = indb['infolisPattern'][pat_id]
-    conf = 1 / len(infolisPattern['linkTo'])
-    for to_id in infolisPattern['linkTo']:
-        linkId = 'link_%s_%s' % (urlescape(from_id), urlescape(to_id))
-        outdb['entity'][from_id] = indb['entity'][from_id]
-        #  outdb['entity'][to_id] = indb['entity'][to_id]
-        outdb['entityLink'][linkId] = {
+    from_id = entity['_id']
+    if escaped_from_id is None:
+        escaped_from_id = urlescape(from_id)
+    link_to = matcher.link_to[pat_idx]
+    conf = 1 / len(link_to)
+    for to_idx in link_to:
+        to_id = matcher.entity_ids[to_idx]
+        linkId = 'link_%s_%s' % (escaped_from_id, matcher.escaped_entity_ids[to_idx])
+        #  outdb.add('entity', to_id, indb['entity'][to_id])
+        link = {
             'confidence': conf,
-            'linkReason': infolisPattern['regexPattern'],
+            'linkReason': matcher.regexes[pat_idx],
             'entityRelations': ['matches_pattern'],
             'fromEntity': from_id,
             'toEntity': to_id
         }
+        outdb.add('entityLink', linkId, link)
+        if links is not None:
+            links[linkId] = link
 
 def make_pattern(db, prefix, title, _id):
     """
@@ -208,7 +607,6 @@ def make_pattern(db, prefix, title, _id):
     Links to '_id'
     """
     #  logging.debug("Link %s/%s to %s" % (prefix, title, _id))
-    regexify = lambda (x) : "\\b" + re.escape(x) + "\\b"
     created = 1
     # --------------------------
     # 1) Whole title
@@ -242,214 +640,3417 @@ def make_pattern(db, prefix, title, _id):
     #                  'linkTo': [] }
     #      db['infolisPattern'][key]['linkTo'] += _id
     return created
+
+def normalize_pattern_string(string_match):
+    """
+    `string_match` with runs of whitespace collapsed to one space
+    """
+    return re.sub(r"\s+", " ", string_match.strip())
+
+def compact_pattern_section(patterns, fold_case=False):
+    """
+    Merge the patterns of an 'infolisPattern' section that match the same
+    string, up to whitespace (and case, if `fold_case`), into one pattern
+    that links to all the entities they linked to.
+
+    The merged pattern has the smallest key and, if `fold_case`, the
+    spelling of that key's pattern, so the other spellings no longer match.
+    Patterns with a regex of their own are kept as they are.
+    """
+    compacted = {}
+    merged = {}
+    for key in sorted(patterns):
+        pat = patterns[key]
+        string_match = pat.get('_stringMatch')
+        if not string_match or pat['regexPattern'] != regexify(string_match):
+            compacted[key] = pat
+            continue
+        string_match = normalize_pattern_string(string_match)
+        group = string_match.lower() if fold_case else string_match
+        if group not in merged:
+            merged[group] = key
+            compacted[key] = dict(pat, _stringMatch=string_match,
+                    regexPattern=regexify(string_match), linkTo=[])
+        link_to = compacted[merged[group]]['linkTo']
+        link_to.extend(to_id for to_id in pat['linkTo'] if to_id not in link_to)
+    return compacted
 #}}}
 
 #-----------------------------------------------------------------------------
-# Do the work
+# Matching
 #{{{
 
-def search_patterns_in_files(dbfile, textfiles, metadir):
-    bakfile = "/tmp/" + urlescape(dbfile) + "_" + urlescape(metadir) + ".json"
-    idstr = re.sub(".*/", "", dbfile) + '_' + re.sub(".*/", "", re.sub("/meta$", "", metadir))
-    outdb = {'entity':{}, 'entityLink':{}}
-    with open(dbfile) as jsoninfile:
-        indb = json.load(jsoninfile)
-        cur = 0
-        total = len(textfiles)
-        total_found = 0
-        logging.info("Start Searching %d files" % total)
-        t0 = time.time()
-        throughput = 0
-        for textfile in textfiles:
-            found = []
-            metafile = metadir + "/" + os.path.splitext(os.path.basename(textfile))[0] + ".xml"
-            entity = make_entity_from_oai(metafile)
-            indb['entity'][entity['_id']] = entity
-            infolis_file, textcontents = make_infolis_file_from_textfile(textfile, entity)
-            for pat_id in indb['infolisPattern']:
-                pat = indb['infolisPattern'][pat_id]
-                #
-                # XXX SEARCH IS HERE
-                #
-                # for efficiency: look for string using 'x in y' syntax first,
-                if pat['_stringMatch'] not in textcontents:
+def is_word_boundary(data, pos):
+    """
+    Whether `\\b` would match at offset `pos` of `data`
+    """
+    before = pos > 0 and data[pos - 1] in WORD_CHARS
+    after = pos < len(data) and data[pos] in WORD_CHARS
+    return before != after
+
+class PatternMatcher(object):
+    """
+    Find all patterns of an 'infolisPattern' section in a text in one pass.
+
+    All '_stringMatch' strings go into one Aho-Corasick automaton over their
+    UTF-8 encoding. A hit is confirmed by checking the word boundaries that
+    `regexify` puts around the string, so the result is the same as running
+    every 'regexPattern'. Patterns whose 'regexPattern' is something else are
+    confirmed with that regex instead, once their string has been found.
+
+    Uses the `ahocorasick` module if it is installed, a pure Python automaton
+    otherwise.
+
+    Patterns are referred to by their index, in the order a loop over the
+    'infolisPattern' dict visits them; 'linkTo' entries are indexes into
+    `entity_ids`, whose `urlescape`d form for link ids is in
+    `escaped_entity_ids`.
+    """
+
+    def __init__(self, patterns=None, source_md5=None):
+        self.source_md5 = source_md5
+        # the order the plain loop over `patterns` would have found them in
+        self.ids = []
+        self.regexes = []
+        self.link_to = []
+        self.entity_ids = []
+        self.escaped_entity_ids = []
+        # patterns without a usable string, must always be tried as regex
+        self.regex_only = []
+        # per keyword: (keyword number, length, exact pattern indexes, regex pattern indexes)
+        self.entries = []
+        self.keywords = {}
+        # where the patterns of each combined pattern set begin
+        self.set_starts = [0]
+        self._goto = self._fail = self._out = None
+        if patterns is None:
+            return
+        entity_index = {}
+        for idx, pat_id in enumerate(patterns):
+            pat = patterns[pat_id]
+            self.ids.append(pat_id)
+            self.regexes.append(pat['regexPattern'])
+            link_to = []
+            for to_id in pat['linkTo']:
+                if to_id not in entity_index:
+                    entity_index[to_id] = len(self.entity_ids)
+                    self.entity_ids.append(to_id)
+                    self.escaped_entity_ids.append(urlescape(to_id))
+                link_to.append(entity_index[to_id])
+            self.link_to.append(tuple(link_to))
+            string_match = pat.get('_stringMatch')
+            if not string_match:
+                self.regex_only.append(idx)
+                continue
+            keyword = string_match.encode('utf-8')
+            if keyword not in self.keywords:
+                self.keywords[keyword] = len(self.entries)
+                self.entries.append((len(self.entries), len(keyword), [], []))
+            entry = self.entries[self.keywords[keyword]]
+            if pat['regexPattern'] == regexify(string_match):
+                entry[2].append(idx)
+            else:
+                entry[3].append(idx)
+        self._build()
+
+    @classmethod
+    def combine(cls, matchers):
+        """
+        One matcher for the patterns of all `matchers`, one set after
+        another, so a single pass over a text finds the patterns of every
+        set. `split_by_set` tells the sets apart again.
+        """
+        if len(matchers) == 1:
+            return matchers[0]
+        combined = cls(source_md5=md5(' '.join(
+            matcher.source_md5 for matcher in matchers)).hexdigest())
+        combined.set_starts = []
+        entity_index = {}
+        for matcher in matchers:
+            offset = len(combined.ids)
+            combined.set_starts.append(offset)
+            combined.ids.extend(matcher.ids)
+            combined.regexes.extend(matcher.regexes)
+            entity_map = []
+            for to_id, escaped in itertools.izip(matcher.entity_ids, matcher.escaped_entity_ids):
+                if to_id not in entity_index:
+                    entity_index[to_id] = len(combined.entity_ids)
+                    combined.entity_ids.append(to_id)
+                    combined.escaped_entity_ids.append(escaped)
+                entity_map.append(entity_index[to_id])
+            combined.link_to.extend(tuple(entity_map[to_idx] for to_idx in link_to)
+                    for link_to in matcher.link_to)
+            combined.regex_only.extend(offset + idx for idx in matcher.regex_only)
+            for keyword, keyword_no in matcher.keywords.iteritems():
+                if keyword not in combined.keywords:
+                    combined.keywords[keyword] = len(combined.entries)
+                    combined.entries.append((len(combined.entries), len(keyword), [], []))
+                entry = combined.entries[combined.keywords[keyword]]
+                entry[2].extend(offset + idx for idx in matcher.entries[keyword_no][2])
+                entry[3].extend(offset + idx for idx in matcher.entries[keyword_no][3])
+        combined._build()
+        return combined
+
+    def split_by_set(self, found):
+        """
+        Split the sorted pattern indexes `found` into one list per pattern set
+        """
+        bounds = [bisect.bisect_left(found, start) for start in self.set_starts[1:]]
+        return [found[lo:hi] for lo, hi in zip([0] + bounds, bounds + [len(found)])]
+
+    def _build(self):
+        """
+        Build the automaton, unless it was loaded already
+        """
+        if ahocorasick:
+            self._automaton = ahocorasick.Automaton()
+            for keyword, keyword_no in self.keywords.iteritems():
+                self._automaton.add_word(keyword, keyword_no)
+            self._automaton.make_automaton()
+            return
+        self._automaton = None
+        if self._goto is not None:
+            return
+        goto = [{}]
+        out = [()]
+        for keyword, keyword_no in self.keywords.iteritems():
+            state = 0
+            for c in keyword:
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    out.append(())
+                    goto[state][c] = nxt
+                state = nxt
+            out[state] = (keyword_no,)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in goto[state].iteritems():
+                queue.append(nxt)
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(c, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def _iter_hits(self, data, deadline=None):
+        """
+        Yield (end offset, entry) for every keyword occurrence in `data`,
+        scanned in blocks of SCAN_BLOCK_BYTES. Raises FileBudgetError if
+        not through at `deadline`.
+        """
+        blocks = (data[pos:pos + SCAN_BLOCK_BYTES] for pos in xrange(0, len(data), SCAN_BLOCK_BYTES))
+        if self._automaton is not None:
+            hits = None
+            for block in blocks:
+                check_deadline(deadline)
+                if hits is None:
+                    hits = self._automaton.iter(block)
+                else:
+                    # go on from the state and offset the last block ended with
+                    hits.set(block, False)
+                for end, keyword_no in hits:
+                    yield end + 1, self.entries[keyword_no]
+            return
+        goto, fail, out, entries = self._goto, self._fail, self._out, self.entries
+        state = 0
+        pos = 0
+        for block in blocks:
+            check_deadline(deadline)
+            for c in block:
+                pos += 1
+                while state and c not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(c, 0)
+                for keyword_no in out[state]:
+                    yield pos, entries[keyword_no]
+
+    def search(self, text, deadline=None):
+        """
+        Return the indexes of all patterns found in `text`, in pattern order.
+
+        `text` is either unicode or UTF-8 encoded bytes. Raises
+        FileBudgetError if not done at `deadline`.
+        """
+        if isinstance(text, unicode):
+            data = text.encode('utf-8')
+        else:
+            data = text
+        found = set()
+        done = set()
+        hit = set()
+        candidates = self._scan(data, found, done, hit, deadline=deadline)
+        self._confirm_regexes(text, data, candidates, found, deadline=deadline)
+        self._count_patterns(hit, found)
+        return sorted(found)
+
+    def search_windows(self, windows, deadline=None):
+        """
+        Like `search`, over the windows of a text from `iter_windows` with
+        an overlap of at least `window_overlap()`. A regex match longer
+        than the overlap may be missed where two windows meet.
+
+        Raises FileBudgetError if not done at `deadline`.
+        """
+        found = set()
+        done = set()
+        hit = set()
+        for window, start, last in windows:
+            candidates = self._scan(window, found, done, hit, start, last, deadline)
+            self._confirm_regexes(None, window, candidates, found, start > 0, last, deadline)
+            check_deadline(deadline)
+        self._count_patterns(hit, found)
+        return sorted(found)
+
+    def window_overlap(self):
+        """
+        How much windows must overlap for every keyword to be found in one
+        of them with the bytes around it
+        """
+        return max([WINDOW_MIN_OVERLAP] + [length + 2 for keyword_no, length, exact, regex in self.entries])
+
+    def _scan(self, data, found, done, hit, start=0, last=True, deadline=None):
+        """
+        Find the keywords in `data` and add the patterns they confirm to
+        `found`, the numbers of the keywords found to `hit` and of those
+        with all their patterns found to `done`. Return the indexes of the
+        patterns to confirm with their regex.
+
+        `data` may be a window of a longer text that begins with the end of
+        the window before: only keywords ending from `start` on, and before
+        the end of `data` unless it is the `last` window, confirm patterns,
+        so each has the bytes around it to check `\b` and is looked at in
+        one window only. Every keyword makes its regexes candidates, as their
+        match may lie in this window only.
+
+        Raises FileBudgetError if not done at `deadline`.
+        """
+        candidates = set(self.regex_only)
+        with METRICS.stage('prefilter'):
+            for end, entry in self._iter_hits(data, deadline):
+                keyword_no, length, exact, regex = entry
+                if keyword_no in done or end < start or (end == len(data) and not last):
+                    candidates.update(regex)
                     continue
-                if re.search(cachedRegex(pat['regexPattern']), textcontents):
-                    found.append(pat_id)
-                    make_entity_link_from_pattern(indb, entity['_id'], pat_id, outdb)
-            cur += 1
-            #  sys.stderr.write(CLEAR)
-            print_progress(cur, total, total_found, t0, idstr)
-            total_found += len(found)
-            if cur % BAK_INTERVAL == 0:
-                logging.debug("Saving intermediary results to %s" % bakfile)
-                with open(bakfile, 'w') as jsonoutfile:
-                    jsonoutfile.write(json.dumps(outdb, indent=2))
-    return outdb
+                hit.add(keyword_no)
+                if exact and not (is_word_boundary(data, end - length)
+                        and is_word_boundary(data, end)):
+                    candidates.update(regex)
+                    continue
+                found.update(exact)
+                candidates.update(regex)
+                done.add(keyword_no)
+        return candidates
 
-#}}}
+    def _count_patterns(self, hit, found):
+        if METRICS.enabled:
+            tried = set(self.regex_only)
+            for keyword_no in hit:
+                tried.update(self.entries[keyword_no][2])
+                tried.update(self.entries[keyword_no][3])
+            METRICS.count_patterns(tried, found)
 
-#-----------------------------------------------------------------------------
-# CLI Commands
-#{{{ 
+    def confirm(self, text, keywords, regex_only=False):
+        """
+        Like `search`, but only try the patterns of `keywords`, and the
+        patterns without one if `regex_only`, which something else like a
+        CorpusIndex found may occur in `text`
+        """
+        if isinstance(text, unicode):
+            data = text.encode('utf-8')
+        else:
+            data = text
+        found = set()
+        candidates = set(self.regex_only) if regex_only else set()
+        for keyword in keywords:
+            keyword_no, length, exact, regex = self.entries[self.keywords[keyword]]
+            pos = data.find(keyword)
+            if pos < 0:
+                continue
+            candidates.update(regex)
+            while exact and pos >= 0:
+                if is_word_boundary(data, pos) and is_word_boundary(data, pos + length):
+                    found.update(exact)
+                    break
+                pos = data.find(keyword, pos + 1)
+        self._confirm_regexes(text, data, candidates, found)
+        return sorted(found)
 
-def search_patterns(dbfile, textdir, metadir, outdbfile):
-    textfiles = glob.glob(textdir + "/*.txt")
-    logging.info("Number of text files: %d" % len(textfiles))
-    db = search_patterns_in_files(dbfile, textfiles, metadir)
-    with open(outdbfile, 'w') as jsonoutfile:
-        logging.info("Finished matching, writing out")
-        jsonoutfile.write(json.dumps(db, indent=2))
+    def _confirm_regexes(self, text, data, candidates, found, after_first=False, last=True, deadline=None):
+        """
+        Add those of the pattern indexes `candidates` whose regex matches to
+        `found`.
 
-def jsonify_dara(darafile, outdbfile):
-    context = ET.iterparse(darafile, events=('end',))
-    db = { "entity": {}, "infolisPattern": {}, "entityLink": {} }
-    cur = 0
-    logging.debug("Counting documents in file ... ")
-    total = int(subprocess.check_output("grep -Fo \"<doc>\" %s|wc -l" % (darafile), shell=True))
-    logging.debug("... finished counting: %d" % total)
-    found = 0
-    t0 = time.time()
-    for action, elem in context:
-        if elem.tag=='doc':
-            entity = make_entity_from_solr_doc(db, elem)
-            if entity:
-                db['entity'][entity['_id']] = entity
-                found += make_pattern(db, 'darapat', entity['name'], entity['_id'])
-                if '_doi' in entity and entity['_doi'] != None:
-                    found += make_pattern(db, 'darapat', entity['_doi'], entity['_id'])
-            cur += 1
-            print_progress(cur, total, found, t0, 'import-dara')
-            elem.clear()
-        if elem.getparent() is None:
-            break
-    with open(outdbfile, 'w') as jsonoutfile:
-        jsonoutfile.write(json.dumps(db, indent=2))
+        If `data` is a window of a longer text, see `_scan`, a match must
+        not begin at its first character in windows `after_first`, nor end
+        at its end in windows before the `last`, where the text around it
+        is missing. Raises FileBudgetError if not done at `deadline`.
+        """
+        candidates = [idx for idx in candidates if idx not in found]
+        if not candidates:
+            return
+        if not isinstance(text, unicode):
+            with METRICS.stage('decode'):
+                text = data.decode('utf-8')
+        pos = 1 if after_first else 0
+        with METRICS.stage('confirm'):
+            for idx in candidates:
+                match = cachedRegex(self.regexes[idx]).search(text, pos)
+                if match and (last or match.end() < len(text)):
+                    found.add(idx)
+                check_deadline(deadline)
 
-def jsonify_databases(infile, outfile):
+    def save(self, indexfile):
+        """
+        Write the compiled patterns to `indexfile`, followed by the pickled
+        automaton if it is an `ahocorasick` one, which loads faster than it
+        is built
+        """
+        index = {
+            'source_md5': self.source_md5,
+            'ids': self.ids,
+            'regexes': self.regexes,
+            'link_to': self.link_to,
+            'entity_ids': self.entity_ids,
+            'escaped_entity_ids': self.escaped_entity_ids,
+            'regex_only': self.regex_only,
+            'entries': self.entries,
+            'keywords': self.keywords,
+            'set_starts': self.set_starts,
+            'goto': self._goto,
+            'fail': self._fail,
+            'out': self._out,
+            'automaton': self._automaton is not None,
+        }
+        with open(indexfile, 'wb') as indexout:
+            indexout.write(PATTERN_INDEX_MAGIC)
+            marshal.dump(index, indexout, 2)
+            if self._automaton is not None:
+                cPickle.dump(self._automaton, indexout, 2)
+
+    @classmethod
+    def load(cls, indexfile):
+        """
+        Read compiled patterns written by `save`. The automaton is only
+        built if it was not saved or `ahocorasick` is not installed.
+        """
+        # what is read is never garbage, spare the collector going through it
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with open(indexfile, 'rb') as indexin:
+                if indexin.read(len(PATTERN_INDEX_MAGIC)) != PATTERN_INDEX_MAGIC:
+                    raise ValueError("Not a pattern index: %s" % indexfile)
+                index = marshal.load(indexin)
+                matcher = cls(source_md5=index['source_md5'])
+                for key in ['ids', 'regexes', 'link_to', 'entity_ids', 'escaped_entity_ids',
+                        'regex_only', 'entries', 'keywords', 'set_starts']:
+                    setattr(matcher, key, index[key])
+                matcher._goto, matcher._fail, matcher._out = index['goto'], index['fail'], index['out']
+                if index['automaton'] and ahocorasick:
+                    matcher._automaton = cPickle.load(indexin)
+                    return matcher
+        finally:
+            if collecting:
+                gc.enable()
+        matcher._build()
+        return matcher
+
+def is_pattern_index(path):
     """
-    Transform the Google Docs Table CSV to a json-import-able structure
+    Whether `path` is a pattern index written by `compile-patterns`
     """
-    db = { "entity": {}, "infolisPattern": {}, 'entityLink': {} }
-    with io.open(infile, 'r', encoding='utf8') as csvfile:
-        total = len(list(csv.reader(open(infile))))
-        csvreader = csv.reader(csvfile)
-        next(csvreader, None)
-        cur = 0
-        found = 0
-        t0 = time.time()
-        for row in csvreader:
-            cur += 1
-            _id = row[DATABASES_CSV_HEADER['ID']]
-            title = row[DATABASES_CSV_HEADER['TITLE']]
-            url = row[DATABASES_CSV_HEADER['URL']]
-            keywords = row[DATABASES_CSV_HEADER['KEYWORDS']].split(" ; ")
-            db['entity'][_id] = {
-                "entityType": 'database',
-                "url": url,
-                "identifier": url,
-                "name": title
-            }
-            found += make_pattern(db, 'dbpat', title, _id)
-            for pat in keywords:
-                if pat != '':
-                    found += make_pattern(db, 'dbpat', pat, _id)
-            print_progress(cur, total, found, t0, 'import-db')
-        with open(outfile, mode="w") as jsonfile:
-            jsonfile.write(json.dumps(db, indent=2))
+    with open(path, 'rb') as f:
+        return f.read(len(PATTERN_INDEX_MAGIC)) == PATTERN_INDEX_MAGIC
 
-def jsonify_icpsr_studies(infile, outfile):
-    db = { "entity": {}, "infolisPattern": {}, "entityLink": {} }
-    with open(infile, 'r') as csvfile:
-        total = len(list(csv.reader(open(infile))))
-        csvreader = csv.reader(csvfile)
-        next(csvreader, None)
-        cur = 0
-        found = 0
-        t0 = time.time()
-        for row in csvreader:
-            _id = "icpsr_" + row[ICPSRSTUDIES_CSV_HEADER['STUDY_NUMBER']]
-            title = row[ICPSRSTUDIES_CSV_HEADER['TITLE']]
-            doi = row[ICPSRSTUDIES_CSV_HEADER['DOI']]
-            db['entity'][_id] = {
-                'name': title,
-                'entityType': 'dataset',
-                'identifier': doi }
-            found += make_pattern(db, 'icpsrpat', title, _id)
-            found += make_pattern(db, 'icpsrpat', doi, _id)
-            cur += 1
-            print_progress(cur, total, found, t0, 'import-icpsr')
-        with open(outfile, mode="w") as jsonfile:
-            jsonfile.write(json.dumps(db, indent=2, encoding='latin1'))
+def file_md5(path):
+    """
+    md5 hex digest of the contents of `path`, read in blocks
+    """
+    digest = md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
 
-# http://stackoverflow.com/a/15836901/201318
-class MergeError(Exception):
-    pass
-def data_merge(a, b):
-    """merges b into a and return merged result
+def compile_pattern_db(dbfile, entitystore=None):
+    """
+    Build a PatternMatcher from the 'infolisPattern' section of a JSON db,
+    read entry by entry so the other sections are never held in memory.
+    The 'entity' section is written to the KeyedStore `entitystore`, if
+    given.
+    """
+    source_md5 = file_md5(dbfile)
+    patterns = {}
+    entities = KeyedStoreWriter(entitystore) if entitystore else None
+    for section, key, value in iter_db_entries(dbfile):
+        if section == 'infolisPattern':
+            patterns[key] = value
+        elif section == 'entity' and entities:
+            entities.add(key, value)
+    if entities:
+        entities.close()
+    return PatternMatcher(patterns, source_md5)
 
-    NOTE: tuples and arbitrary objects are not handled as it is totally ambiguous what should happen"""
-    key = None
-    # ## debug output
-    # sys.stderr.write("DEBUG: %s to %s\n" %(b,a))
+def open_target_entities(dbfile):
+    """
+    The KeyedStore of the entities of `dbfile` that its patterns link to,
+    which `compile-patterns` writes to `<index>.entities`. For a JSON db it
+    is (re)written next to it if missing or older than the db.
+    """
+    if is_pattern_index(dbfile):
+        return KeyedStore(dbfile + '.entities')
+    storefile = os.path.splitext(dbfile)[0] + '.idx.entities'
+    if not os.path.exists(storefile + '.index') or \
+            os.path.getmtime(storefile + '.index') < os.path.getmtime(dbfile):
+        logging.info("Storing the entities of %s in %s" % (dbfile, storefile))
+        store = KeyedStoreWriter(storefile)
+        for section, key, value in iter_db_entries(dbfile):
+            if section == 'entity':
+                store.add(key, value)
+        store.close()
+    return KeyedStore(storefile)
+
+class TargetEntities(object):
+    """
+    Add the entities that links point to to the output of their pattern
+    set, once each, read from the pattern set's KeyedStore when first needed
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.written = [set() for store in stores]
+
+    def add(self, set_no, outdb, to_id):
+        if to_id in self.written[set_no]:
+            return
+        self.written[set_no].add(to_id)
+        entity = self.stores[set_no].get(to_id)
+        if entity is None:
+            logging.warn("No entity %s to link to" % to_id)
+            return
+        outdb.add('entity', to_id, entity)
+
+def load_pattern_matcher(dbfile):
+    """
+    Get the PatternMatcher for `dbfile`, which is either a pattern index or
+    a JSON db. For a JSON db, the index next to it is used if it was compiled
+    from the same JSON, and (re)written otherwise.
+    """
+    if is_pattern_index(dbfile):
+        logging.info("Loading pattern index %s" % dbfile)
+        return PatternMatcher.load(dbfile)
+    indexfile = os.path.splitext(dbfile)[0] + '.idx'
+    source_md5 = file_md5(dbfile)
+    if os.path.exists(indexfile) and is_pattern_index(indexfile):
+        matcher = PatternMatcher.load(indexfile)
+        if matcher.source_md5 == source_md5:
+            logging.info("Using pattern index %s" % indexfile)
+            return matcher
+        logging.info("Pattern index %s is outdated" % indexfile)
+    logging.info("Compiling patterns from %s" % dbfile)
+    matcher = compile_pattern_db(dbfile)
     try:
-        if a is None or isinstance(a, str) or isinstance(a, unicode) or isinstance(a, int) or isinstance(a, long) or isinstance(a, float):
-            # border case for first run or if a is a primitive
-            a = b
-        elif isinstance(a, list):
-            # lists can be only appended
-            if isinstance(b, list):
-                # merge lists
-                a.extend(b)
-            else:
-                # append to list
-                a.append(b)
-        elif isinstance(a, dict):
-            # dicts must be merged
-            if isinstance(b, dict):
-                for key in b:
-                    if key in a:
-                        a[key] = data_merge(a[key], b[key])
-                    else:
-                        a[key] = b[key]
-            else:
-                raise MergeError('Cannot merge non-dict "%s" into dict "%s"' % (b, a))
-        else:
-            raise MergeError('NOT IMPLEMENTED "%s" into "%s"' % (b, a))
-    except TypeError, e:
-        raise MergeError('TypeError "%s" in key "%s" when merging "%s" into "%s"' % (e, key, b, a))
-    return a
+        matcher.save(indexfile)
+        logging.info("Saved pattern index %s" % indexfile)
+    except IOError, e:
+        logging.warn("Could not save pattern index %s: %s" % (indexfile, e))
+    return matcher
 
 #}}}
 
-
 #-----------------------------------------------------------------------------
-# Main
-#{{{ 
+# Output
+#{{{
 
-def print_usage(exit_code):
-    prog = sys.argv[0]
-    print("Usage: " + prog + " <command> [args...]")
-    print("""
-    Commands:
+class JsonOutput(object):
+    """
+    Collect entities and links in memory and write them as one JSON db
+    """
 
-    jsonify-databases <csv> <out-json>
-        Convert Databases CSV <csv> to JSON
+    def __init__(self, path):
+        self.path = path
+        self.db = {'entity': {}, 'entityLink': {}}
 
-    jsonify-dara <solr-xml> <out-json>
-        Convert da-ra solr xml to JSON
+    def add(self, section, key, value):
+        self.db[section][key] = value
+
+    def close(self):
+        with open(self.path, 'w') as jsonoutfile:
+            jsonoutfile.write(json.dumps(self.db, indent=2, sort_keys=True))
+
+class NdjsonOutput(object):
+    """
+    Append entities and links to a file as they are found, one JSON line
+    `{section: {key: value}}` each, gzip-compressed if the name ends in
+    '.gz'. Lines are written in batches of BAK_INTERVAL.
+
+    A key can occur more than once, the last line wins, as it would in the
+    JSON db. `finalize-ndjson` turns the file into that JSON db.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.gz'):
+            self.outfile = gzip.open(path, 'wb')
+        else:
+            self.outfile = open(path, 'w')
+        self.pending = []
+
+    def add(self, section, key, value):
+        self.pending.append(json.dumps({section: {key: value}}, sort_keys=True))
+        if len(self.pending) >= BAK_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.outfile.write("\n".join(self.pending) + "\n")
+        self.outfile.flush()
+        self.pending = []
+
+    def close(self):
+        if self.pending:
+            self.flush()
+        self.outfile.close()
+
+class JsonDbWriter(object):
+    """
+    Write a JSON db entry by entry instead of serializing it in one go.
+    The entries of a section must be added one after another; sections
+    that got no entries are written empty.
+    """
+
+    def __init__(self, path, sections=('entity', 'infolisPattern', 'entityLink')):
+        self.outfile = open(path, 'w')
+        self.sections = list(sections)
+        self.written = []
+        self.section = None
+        self.outfile.write("{")
+
+    def _begin(self, section):
+        if self.section is not None:
+            self.outfile.write("\n}")
+        if section in self.written:
+            raise ValueError("Section '%s' was already written" % section)
+        if self.written:
+            self.outfile.write(",")
+        self.outfile.write("\n%s: {" % json.dumps(section))
+        self.written.append(section)
+        self.section = section
+        self.first = True
+
+    def add(self, section, key, value):
+        if section != self.section:
+            self._begin(section)
+        if not self.first:
+            self.outfile.write(",")
+        self.first = False
+        self.outfile.write("\n  %s: %s" % (json.dumps(key), json.dumps(value, sort_keys=True)))
+
+    def close(self):
+        for section in self.sections:
+            if section not in self.written:
+                self._begin(section)
+        if self.section is not None:
+            self.outfile.write("\n}")
+        self.outfile.write("\n}\n")
+        self.outfile.close()
+
+def open_db_output(path):
+    """
+    NdjsonOutput for '.ndjson' and '.ndjson.gz' files, JsonOutput otherwise
+    """
+    if re.search(r"\.ndjson(\.gz)?$", path):
+        return NdjsonOutput(path)
+    return JsonOutput(path)
+
+class ShardError(Exception):
+    pass
+
+def parse_shard(spec):
+    """
+    (i, N) from an 'i/N' --shard argument, 1 <= i <= N
+    """
+    try:
+        shard, shards = [int(n) for n in spec.split('/')]
+    except ValueError:
+        raise ValueError("--shard must be i/N, not %s" % spec)
+    if not 1 <= shard <= shards:
+        raise ValueError("--shard %s is not one of 1/%d to %d/%d" % (spec, shards, shards, shards))
+    return shard, shards
+
+def in_shard(textfile, shard, shards):
+    """
+    Whether `textfile` is searched by shard `shard` of `shards`. Only its
+    name counts, so all hosts agree wherever the dataset root is mounted.
+    """
+    name = os.path.basename(textfile)
+    return int(md5(name).hexdigest()[:8], 16) % shards == shard - 1
+
+def names_md5(names):
+    return md5("\n".join(os.path.basename(name) for name in names)).hexdigest()
+
+class ShardOutput(object):
+    """
+    Pass entries on to the output of one shard and record, in
+    `<path>.shard`, where the shard comes from and how many entries each
+    file produced, for `merge-shards`
+    """
+
+    def __init__(self, outdb, path, provenance, corpus_names):
+        self.outdb = outdb
+        self.path = path
+        self.provenance = dict(provenance)
+        self.file_nos = dict((name, file_no) for file_no, name in enumerate(corpus_names))
+        self.count = 0
+        self.output = []
+
+    def add(self, section, key, value):
+        self.outdb.add(section, key, value)
+        self.count += 1
+
+    def end_file(self, textfile):
+        if self.count:
+            self.output.append((self.file_nos[textfile], self.count))
+            self.count = 0
+
+    def close(self):
+        self.outdb.close()
+        self.provenance['output'] = self.output
+        with open(self.path + '.shard', 'w') as shardout:
+            json.dump(self.provenance, shardout, sort_keys=True)
+
+def iter_ndjson(path):
+    """
+    Yield (section, key, value) for every line written by NdjsonOutput
+    """
+    if path.endswith('.gz'):
+        infile = gzip.open(path, 'rb')
+    else:
+        infile = open(path)
+    with infile:
+        for line in infile:
+            for section, entries in json.loads(line).iteritems():
+                for key, value in entries.iteritems():
+                    yield section, key, value
+
+class JsonStream(object):
+    """
+    Decode a JSON document piece by piece from a file, so that only the
+    value being decoded has to be in memory
+    """
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.blocksize = 1 << 20
+
+    def _fill(self):
+        block = self.infile.read(self.blocksize)
+        if not block:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, '' at the end
+        """
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        """
+        Consume the next character, which must be one of `chars`
+        """
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of '%s' but got '%s'" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode the next complete JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                end = None
+            # a value that ends with the buffer might go on after it
+            if end is None or (end == len(self.buf) and not self.eof):
+                self._fill()
+                self.blocksize *= 2
+                continue
+            self.blocksize = 1 << 20
+            self.pos = end
+            return value
+
+def iter_json_db(path, sections=None):
+    """
+    Yield (section, key, value) for every entry of a JSON db, decoding one
+    entry at a time. The names of all sections, including empty ones, are
+    appended to `sections` if it is given.
+    """
+    with open(path, 'rb') as jsonin:
+        stream = JsonStream(jsonin)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            section = stream.value()
+            if sections is not None:
+                sections.append(section)
+            stream.expect(':')
+            stream.expect('{')
+            if stream.peek() == '}':
+                stream.expect('}')
+            else:
+                while True:
+                    key = stream.value()
+                    stream.expect(':')
+                    value = stream.value()
+                    yield section, key, value
+                    if stream.expect(',}') == '}':
+                        break
+            if stream.expect(',}') == '}':
+                break
+
+def iter_db_entries(path, sections=None):
+    """
+    Yield (section, key, value) for every entry of a JSON or NDJSON db
+    """
+    if re.search(r"\.ndjson(\.gz)?$", path):
+        return iter_ndjson(path)
+    return iter_json_db(path, sections)
+
+def most_common(counter, n):
+    """
+    The `n` most common items of `counter`, the same on every run
+    """
+    return heapq.nsmallest(n, counter.iteritems(), key=lambda (item, count): (-count, item))
+
+class LinkSummary(object):
+    """
+    Link counts of an output, in total, per pattern ('linkReason'), per
+    target entity and per corpus, and a histogram of their confidence.
+
+    Links are counted by id, the last of several with the same id winning
+    as in the output, so a link written again for another text file of the
+    same entity counts once. The corpus of an output read without a
+    summary is UNKNOWN_CORPUS.
+    """
+
+    def __init__(self, corpus=None):
+        self.corpus = corpus
+        # link id -> (corpus, linkReason, toEntity, fromEntity, confidence bin)
+        self.links = {}
+        # the counts of the summaries added with `update`
+        self.patterns = Counter()
+        self.targets = Counter()
+        self.confidence = Counter()
+        # corpus -> [links, entities with links]
+        self.corpora = {}
+
+    def add_entity_links(self, links, corpus=None):
+        """
+        Count the links of one source entity, {link id: link}
+        """
+        for link_id, link in links.iteritems():
+            conf_bin = min(int(link['confidence'] * CONFIDENCE_BINS), CONFIDENCE_BINS)
+            self.links[link_id] = (corpus or self.corpus, link['linkReason'], link['toEntity'],
+                    link['fromEntity'], '%.1f' % (conf_bin / float(CONFIDENCE_BINS)))
+
+    def add_db(self, dbfile, corpus=UNKNOWN_CORPUS):
+        """
+        Count the links of a JSON or NDJSON db, reading it entry by entry
+        """
+        for section, key, value in iter_db_entries(dbfile):
+            if section == 'entityLink':
+                self.add_entity_links({key: value}, corpus)
+
+    def update(self, summary):
+        """
+        Add the counts of a summary written by `save`
+        """
+        self.patterns.update(summary['patterns'])
+        self.targets.update(summary['targets'])
+        self.confidence.update(summary['confidence'])
+        for corpus, counts in summary['corpora'].iteritems():
+            own = self.corpora.setdefault(corpus, [0, 0])
+            own[0] += counts['links']
+            own[1] += counts['entities']
+
+    def as_dict(self, top=SUMMARY_TOP):
+        patterns = Counter(self.patterns)
+        targets = Counter(self.targets)
+        confidence = Counter(self.confidence)
+        corpora = dict((corpus, list(counts)) for corpus, counts in self.corpora.iteritems())
+        sources = {}
+        for corpus, reason, to_id, from_id, conf_key in self.links.itervalues():
+            patterns[reason] += 1
+            targets[to_id] += 1
+            confidence[conf_key] += 1
+            corpora.setdefault(corpus, [0, 0])[0] += 1
+            sources.setdefault(corpus, set()).add(from_id)
+        for corpus, from_ids in sources.iteritems():
+            corpora[corpus][1] += len(from_ids)
+        return {
+            'links': sum(counts[0] for counts in corpora.itervalues()),
+            'entities': sum(counts[1] for counts in corpora.itervalues()),
+            'corpora': dict((corpus, {'links': counts[0], 'entities': counts[1]})
+                for corpus, counts in corpora.iteritems()),
+            'confidence': dict(confidence),
+            'patterns': dict(patterns),
+            'targets': dict(targets),
+            'top_patterns': most_common(patterns, top),
+            'top_targets': most_common(targets, top),
+        }
+
+    def save(self, path, top=SUMMARY_TOP):
+        with open(path, 'w') as summaryout:
+            json.dump(self.as_dict(top), summaryout, indent=2, sort_keys=True)
+
+def npy_bytes(descr, shape, data):
+    """
+    An array in NumPy's .npy format, version 1.0, from its dtype `descr`,
+    its `shape` and its raw `data`
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (descr, shape)
+    # the data starts at a multiple of 64 bytes, as NumPy writes it
+    header += ' ' * (-(10 + len(header) + 1) % 64) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header + data
+
+def int_npy_bytes(values):
+    """
+    .npy of an array.array of ints
+    """
+    return npy_bytes('%si%d' % ('<' if sys.byteorder == 'little' else '>', values.itemsize),
+            (len(values),), values.tostring())
+
+def string_npy_bytes(strings):
+    """
+    .npy of strings, UTF-8 encoded, as a NumPy bytes array
+    """
+    strings = [string.encode('utf-8') if isinstance(string, unicode) else string for string in strings]
+    width = max([1] + [len(string) for string in strings])
+    return npy_bytes('|S%d' % width, (len(strings),),
+            ''.join(string.ljust(width, '\0') for string in strings))
+
+class HitMatrix(object):
+    """
+    The patterns of one pattern set found in each searched file, as a
+    sparse files x patterns matrix in compressed sparse row form
+    ('indptr', 'indices'). `save` writes it with the tables that name its
+    rows and columns as an .npz file, which `numpy.load` reads, without
+    needing NumPy itself.
+
+    The rows are the files a pattern of the set was found in ('files') and
+    the entities they manifest ('entities'), the columns the patterns of
+    the set in matcher order ('pattern_ids', 'pattern_regexes'), whose
+    'linkTo' are 'link_indptr' and 'link_indices' into 'entity_ids'.
+    'files_searched' counts all searched files, with a hit or not.
+    """
+
+    def __init__(self, matcher=None):
+        self.matcher = matcher
+        self.files = []
+        self.entities = []
+        self.indptr = array.array('l', [0])
+        self.indices = array.array('i')
+        self.files_searched = 0
+
+    def add(self, record, found, offset=0):
+        """
+        Add the row of a manifest record, `found` being the indexes of the
+        patterns of the set in it, counted from `offset`
+        """
+        self.files_searched += 1
+        if not found:
+            return
+        self.files.append(record['file'])
+        self.entities.append(record['entity']['_id'])
+        self.indices.extend(pat_idx - offset for pat_idx in found)
+        self.indptr.append(len(self.indices))
+
+    def save(self, path):
+        link_indptr = array.array('l', [0])
+        link_indices = array.array('i')
+        for link_to in self.matcher.link_to:
+            link_indices.extend(link_to)
+            link_indptr.append(len(link_indices))
+        arrays = [
+            ('indptr', int_npy_bytes(self.indptr)),
+            ('indices', int_npy_bytes(self.indices)),
+            ('files', string_npy_bytes(self.files)),
+            ('entities', string_npy_bytes(self.entities)),
+            ('pattern_ids', string_npy_bytes(self.matcher.ids)),
+            ('pattern_regexes', string_npy_bytes(self.matcher.regexes)),
+            ('link_indptr', int_npy_bytes(link_indptr)),
+            ('link_indices', int_npy_bytes(link_indices)),
+            ('entity_ids', string_npy_bytes(self.matcher.entity_ids)),
+            ('files_searched', npy_bytes('<i8', (), struct.pack('<q', self.files_searched))),
+        ]
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as npzout:
+            for name, data in arrays:
+                npzout.writestr(name + '.npy', data)
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Run manifest
+#{{{
+
+def open_json_lines(path, resume, match=None):
+    """
+    Open `path`, a file of JSON records one per line like a run manifest,
+    to append records to. Return it and an iterator over the records it
+    already holds if `resume`, to read before appending; otherwise the
+    file is emptied and there are none. Only the records with the values
+    of `match` are read.
+    """
+    if not (resume and os.path.exists(path)):
+        return open(path, 'w'), iter(())
+    def records():
+        with open(path) as linesin:
+            for line in linesin:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of a crashed run
+                    continue
+                if match and any(record.get(key) != value for key, value in match.iteritems()):
+                    continue
+                yield record
+    return open(path, 'a'), records()
+
+class RunManifest(object):
+    """
+    Remembers which text files were searched against which pattern set and
+    what was found, so an interrupted or repeated search can skip them.
+
+    The manifest is a file of JSON records, one line per searched file,
+    appended to in batches. A record holds the file's path, size, mtime and
+    md5, the md5 of the pattern source ('patterns'), the indexes of the
+    patterns found and, if any were found, the entity the file manifests.
+    A file skipped for the FILE_BUDGET has a record saying why ('skipped').
+
+    Records of the pattern set with md5 `previous_md5` are kept apart, for a
+    PatternDelta to bring them up to date.
+    """
+
+    def __init__(self, path, patterns_md5, resume=False, previous_md5=None):
+        self.path = path
+        self.patterns_md5 = patterns_md5
+        # path -> latest record for the current pattern set
+        self.by_file = {}
+        # md5 of the text -> latest record for the current pattern set
+        self.by_md5 = {}
+        # path -> latest record for the previous pattern set
+        self.previous = {}
+        self.pending = []
+        self.manifestout, records = open_json_lines(path, resume)
+        for record in records:
+            if 'skipped' in record:
+                # over the FILE_BUDGET, to be tried again
+                self.by_file.pop(record['file'], None)
+                self.previous.pop(record['file'], None)
+                continue
+            if record['patterns'] == patterns_md5:
+                self.by_file[record['file']] = record
+                self.by_md5[record['md5']] = record
+                self.previous.pop(record['file'], None)
+            elif previous_md5 and record['patterns'] == previous_md5:
+                self.previous[record['file']] = record
+        if resume:
+            logging.info("Resuming with %d files from %s" % (len(self.by_file), path))
+
+    def lookup(self, textfile, stat, previous=False):
+        """
+        The record for `textfile` if it is unchanged since it was searched
+        with the current pattern set, or the previous one if `previous`,
+        going by its (size, mtime) `stat`, None otherwise
+        """
+        record = (self.previous if previous else self.by_file).get(textfile)
+        if record is None:
+            return None
+        if (record['size'], record['mtime']) != stat:
+            return None
+        return record
+
+    def add(self, record):
+        record['patterns'] = self.patterns_md5
+        self.pending.append(json.dumps(record))
+        if len(self.pending) >= BAK_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        for line in self.pending:
+            self.manifestout.write(line + "\n")
+        self.manifestout.flush()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.manifestout.close()
+
+class PatternDelta(object):
+    """
+    What changed between two versions of a pattern db, as written by
+    `diff-patterns`, applied to the manifest records of a search with the
+    old version.
+
+    Patterns whose string and regex are unchanged are found where they were
+    found before, so only added patterns and those whose string or regex
+    changed (`rescan`) need to be searched for. A change of 'linkTo' alone
+    only changes the links written, and their confidence.
+    """
+
+    def __init__(self, deltafile):
+        with open(deltafile) as deltain:
+            delta = json.load(deltain)
+        self.old_md5 = delta['old']['md5']
+        self.new_md5 = delta['new']['md5']
+        self.old_ids = delta['old']['ids']
+        self.added = delta['added']
+        self.removed = delta['removed']
+        self.changed = delta['changed']
+
+    def prepare(self, matcher):
+        """
+        Set up the translation to the pattern indexes of `matcher`, which
+        must have been built from the new version
+        """
+        if matcher.source_md5 != self.new_md5:
+            raise ValueError("The delta is for a pattern db with md5 %s, not %s" % (
+                self.new_md5, matcher.source_md5))
+        new_index = dict((pat_id, idx) for idx, pat_id in enumerate(matcher.ids))
+        rescan = dict(self.added)
+        for key, change in self.changed.iteritems():
+            if (change['old'].get('_stringMatch'), change['old']['regexPattern']) != \
+                    (change['new'].get('_stringMatch'), change['new']['regexPattern']):
+                rescan[key] = change['new']
+        # old pattern index -> new pattern index, for the patterns found as before
+        self.kept = dict((old_idx, new_index[pat_id]) for old_idx, pat_id in enumerate(self.old_ids)
+                if pat_id in new_index and pat_id not in rescan)
+        self.rescan_matcher = PatternMatcher(rescan, self.new_md5)
+        self.rescan_index = [new_index[pat_id] for pat_id in self.rescan_matcher.ids]
+        logging.info("%d patterns kept, %d to search for" % (len(self.kept), len(rescan)))
+
+    def apply(self, previous, rescanned, metadata):
+        """
+        The record for the new pattern db from the `previous` record of a
+        file and the `rescanned` record of searching it for the patterns to
+        rescan
+        """
+        found = set(self.kept[idx] for idx in previous['found'] if idx in self.kept)
+        found.update(self.rescan_index[idx] for idx in rescanned['found'])
+        record = dict(rescanned, found=sorted(found))
+        record.pop('entity', None)
+        if found:
+            record['entity'] = previous.get('entity') or rescanned.get('entity') or \
+                    metadata.entity(record['file'])
+        return record
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Metadata
+#{{{
+
+class Archive(object):
+    """
+    The files with a name ending in `suffix` in a tar archive, compressed or
+    not, or a zip archive, read without unpacking the archive.
+
+    Members of a zip or uncompressed tar archive are read where they are.
+    A compressed tar archive can only be read from its start, so reading
+    moves forward through it. The members it passes over are kept, up to
+    ARCHIVE_SKIPPED_BYTES, and it only starts over when asked for a member
+    it passed and no longer has: reading the members in about the order of
+    `names`, or of another archive with the same files, is one pass over
+    the archive. Each process reads with its own pass.
+    """
+
+    def __init__(self, path, suffix):
+        self.path = path
+        self.names = []
+        # name -> (size, mtime, offset of the data in an uncompressed tar)
+        self.members = {}
+        self.zip = None
+        self.mm = None
+        self.sequential = False
+        self.lock = threading.Lock()
+        self.stream = None
+        self.stream_pid = None
+        self.skipped = OrderedDict()
+        self.skipped_bytes = 0
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            for info in self.zip.infolist():
+                if info.filename.endswith(suffix):
+                    self.names.append(info.filename)
+                    self.members[info.filename] = (info.file_size,
+                            time.mktime(info.date_time + (0, 0, -1)), None)
+            return
+        try:
+            tar = tarfile.open(path, 'r:')
+        except tarfile.ReadError:
+            tar = tarfile.open(path, 'r:*')
+            self.sequential = True
+        with tar:
+            for info in tar:
+                if info.isfile() and info.name.endswith(suffix):
+                    self.names.append(info.name)
+                    self.members[info.name] = (info.size, info.mtime, info.offset_data)
+                # the member list of a large archive would take much memory
+                tar.members = []
+        self.positions = dict((name, pos) for pos, name in enumerate(self.names))
+        if not self.sequential and os.path.getsize(path):
+            with open(path, 'rb') as tarin:
+                self.mm = mmap.mmap(tarin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def stat(self, name):
+        """
+        (size, mtime) of member `name`
+        """
+        size, mtime, offset = self.members[name]
+        return size, mtime
+
+    def read(self, name):
+        """
+        The contents of member `name`
+        """
+        if self.zip is not None:
+            return self.zip.read(name)
+        size, mtime, offset = self.members[name]
+        if not self.sequential:
+            return self.mm[offset:offset + size] if size else ''
+        with self.lock:
+            if self.stream_pid != os.getpid():
+                # forked from the process that opened the stream
+                self.stream = None
+                self.skipped.clear()
+                self.skipped_bytes = 0
+            if name in self.skipped:
+                contents = self.skipped.pop(name)
+                self.skipped_bytes -= len(contents)
+                return contents
+            if self.stream is None or self.positions[name] < self.stream_position:
+                if self.stream is not None:
+                    logging.warn("Reading %s from the start again for %s" % (self.path, name))
+                    self.stream.close()
+                self.stream = tarfile.open(self.path, 'r|*')
+                self.stream_pid = os.getpid()
+                self.stream_position = 0
+            for info in self.stream:
+                self.stream.members = []
+                if info.name not in self.positions or not info.isfile():
+                    continue
+                self.stream_position = self.positions[info.name] + 1
+                contents = self.stream.extractfile(info).read()
+                if info.name == name:
+                    return contents
+                self.skipped[info.name] = contents
+                self.skipped_bytes += len(contents)
+                while self.skipped_bytes > ARCHIVE_SKIPPED_BYTES:
+                    self.skipped_bytes -= len(self.skipped.popitem(last=False)[1])
+        raise KeyError("%s not found in %s" % (name, self.path))
+
+class KeyedStore(object):
+    """
+    JSON values stored under string keys in one file, read through mmap.
+    The offsets and lengths of the values are in `<path>.index`. Written by
+    KeyedStoreWriter.
+    """
+
+    loads = staticmethod(json.loads)
+
+    def __init__(self, path):
+        with open(path + '.index', 'rb') as indexin:
+            if indexin.read(len(KEYED_STORE_MAGIC)) != KEYED_STORE_MAGIC:
+                raise ValueError("Not a keyed store index: %s.index" % path)
+            self.index = marshal.loads(indexin.read())
+        self.mm = None
+        if os.path.getsize(path):
+            with open(path, 'rb') as storein:
+                self.mm = mmap.mmap(storein.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key, default=None):
+        if key not in self.index:
+            return default
+        offset, length = self.index[key]
+        return self.loads(self.mm[offset:offset + length])
+
+class KeyedStoreWriter(object):
+    """
+    Write a KeyedStore, value by value
+    """
+
+    dumps = staticmethod(lambda value: json.dumps(value, sort_keys=True))
+
+    def __init__(self, path):
+        self.path = path
+        self.storeout = open(path, 'wb')
+        self.index = {}
+
+    def add(self, key, value):
+        data = self.dumps(value)
+        self.index[key] = (self.storeout.tell(), len(data))
+        self.storeout.write(data)
+
+    def close(self):
+        self.storeout.close()
+        with open(self.path + '.index', 'wb') as indexout:
+            indexout.write(KEYED_STORE_MAGIC)
+            marshal.dump(self.index, indexout, 2)
+
+def metadata_key(textfile):
+    """
+    The name, without extension, shared by a text file and its OAI metadata
+    """
+    return os.path.splitext(os.path.basename(textfile))[0]
+
+class MetadataDirectory(object):
+    """
+    Entities parsed from the OAI-PMH XML files in a directory on demand
+    """
+
+    def __init__(self, metadir):
+        self.metadir = metadir
+
+    def metafile(self, textfile):
+        return self.metadir + "/" + metadata_key(textfile) + ".xml"
+
+    def prefetch(self, textfile):
+        """
+        The XML of the metadata of `textfile`, read but not yet parsed, or
+        None if it cannot be read
+        """
+        try:
+            with open(self.metafile(textfile), 'rb') as metain:
+                return metain.read()
+        except IOError, e:
+            return None
+
+    def entity(self, textfile, prefetched=None):
+        if prefetched is not None:
+            return make_entity_from_oai(io.BytesIO(prefetched))
+        return make_entity_from_oai(self.metafile(textfile))
+
+class MetadataArchive(object):
+    """
+    Entities parsed on demand from the OAI-PMH XML files in a tar or zip
+    archive, paired with the text files by name as in a directory
+    """
+
+    def __init__(self, archivepath):
+        self.archive = Archive(archivepath, '.xml')
+        self.members = dict((metadata_key(name), name) for name in self.archive.names)
+
+    def prefetch(self, textfile):
+        member = self.members.get(metadata_key(textfile))
+        if member is None:
+            return None
+        return self.archive.read(member)
+
+    def entity(self, textfile, prefetched=None):
+        if prefetched is None:
+            prefetched = self.prefetch(textfile)
+            if prefetched is None:
+                raise KeyError("No metadata for %s" % textfile)
+        return make_entity_from_oai(io.BytesIO(prefetched))
+
+class MetadataIndex(object):
+    """
+    Entities looked up in a KeyedStore written by `index_metadata`
+    """
+
+    def __init__(self, storefile):
+        self.store = KeyedStore(storefile)
+
+    def prefetch(self, textfile):
+        # a lookup in the store is as cheap as keeping its result
+        return None
+
+    def entity(self, textfile, prefetched=None):
+        entity = self.store.get(metadata_key(textfile))
+        if entity is None:
+            raise KeyError("No metadata for %s" % textfile)
+        return entity
+
+def open_metadata(metadir):
+    """
+    A MetadataDirectory for a directory, a MetadataArchive for an archive,
+    a MetadataIndex otherwise
+    """
+    if os.path.isdir(metadir):
+        return MetadataDirectory(metadir)
+    if ARCHIVE_RE.search(metadir):
+        return MetadataArchive(metadir)
+    return MetadataIndex(metadir)
+
+def index_metadata(metadir, storefile):
+    """
+    Parse the entities from all OAI-PMH XML files in `metadir` (directory
+    or archive) once and store them in `storefile`
+    """
+    if os.path.isdir(metadir):
+        metafiles = glob.glob(metadir + "/*.xml")
+        read_metafile = lambda metafile: metafile
+    else:
+        archive = Archive(metadir, '.xml')
+        metafiles = archive.names
+        read_metafile = lambda metafile: io.BytesIO(archive.read(metafile))
+    total = len(metafiles)
+    t0 = time.time()
+    store = KeyedStoreWriter(storefile)
+    for cur, metafile in enumerate(metafiles, 1):
+        store.add(metadata_key(metafile), make_entity_from_oai(read_metafile(metafile)))
+        print_progress(cur, total, cur, t0, 'index-metadata')
+    store.close()
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Corpora
+#{{{
+
+class DirectoryCorpus(object):
+    """
+    The *.txt files in a directory
+    """
+
+    def __init__(self, textdir):
+        self.names = sorted(glob.glob(textdir + "/*.txt"))
+
+    def stat(self, textfile):
+        """
+        (size, mtime) of `textfile`
+        """
+        stat = os.stat(textfile)
+        return stat.st_size, stat.st_mtime
+
+    def read(self, textfile):
+        """
+        The UTF-8 text of `textfile` and the md5 of the file
+        """
+        return read_textfile(textfile)
+
+class PackedCorpus(object):
+    """
+    Texts packed into one file by `pack_corpus`, read through mmap.
+
+    The pack holds the texts as UTF-8, one after another, the index next to
+    it (`<packfile>.index`) their original paths, offsets and lengths in the
+    pack and the md5, size and mtime of the original files. Reading a text
+    needs no open, md5 or decode.
+    """
+
+    def __init__(self, packfile):
+        with open(packfile + '.index', 'rb') as indexin:
+            if indexin.read(len(PACKED_CORPUS_MAGIC)) != PACKED_CORPUS_MAGIC:
+                raise ValueError("Not a packed corpus index: %s.index" % packfile)
+            index = marshal.loads(indexin.read())
+        self.names = index['names']
+        self.entries = dict(itertools.izip(self.names, itertools.izip(
+            index['offsets'], index['lengths'], index['md5s'], index['sizes'], index['mtimes'])))
+        with open(packfile, 'rb') as packin:
+            self.mm = mmap.mmap(packin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def stat(self, textfile):
+        offset, length, digest, size, mtime = self.entries[textfile]
+        return size, mtime
+
+    def read(self, textfile):
+        offset, length, digest, size, mtime = self.entries[textfile]
+        return self.mm[offset:offset + length], digest
+
+class ArchiveCorpus(object):
+    """
+    The *.txt files in a tar or zip archive, in the order they are in it,
+    see Archive. Their names are the path of the archive joined with their
+    path in it.
+    """
+
+    def __init__(self, archivepath):
+        self.archive = Archive(archivepath, '.txt')
+        self.names = [os.path.join(archivepath, name) for name in self.archive.names]
+        self.members = dict(itertools.izip(self.names, self.archive.names))
+
+    def stat(self, textfile):
+        return self.archive.stat(self.members[textfile])
+
+    def read(self, textfile):
+        with METRICS.stage('read'):
+            textcontents = self.archive.read(self.members[textfile])
+        with METRICS.stage('md5'):
+            digest = md5(textcontents).hexdigest()
+        return textcontents, digest
+
+def open_corpus(textdir):
+    """
+    A DirectoryCorpus for a directory, an ArchiveCorpus for an archive, a
+    PackedCorpus otherwise
+    """
+    if os.path.isdir(textdir):
+        return DirectoryCorpus(textdir)
+    if ARCHIVE_RE.search(textdir):
+        return ArchiveCorpus(textdir)
+    return PackedCorpus(textdir)
+
+def pack_corpus(textdir, packfile):
+    """
+    Pack the *.txt files in `textdir` into `packfile` and `packfile`.index
+    """
+    index = {'names': [], 'offsets': [], 'lengths': [], 'md5s': [], 'sizes': [], 'mtimes': []}
+    textfiles = sorted(glob.glob(textdir + "/*.txt"))
+    total = len(textfiles)
+    t0 = time.time()
+    with open(packfile, 'wb') as packout:
+        for cur, textfile in enumerate(textfiles, 1):
+            stat = os.stat(textfile)
+            with open(textfile, 'rb') as textin:
+                textcontents = textin.read()
+            try:
+                text = textcontents.decode('utf-8').encode('utf-8')
+            except UnicodeDecodeError, e:
+                logging.warn("%s is not UTF-8, replacing invalid bytes: %s" % (textfile, e))
+                text = textcontents.decode('utf-8', 'replace').encode('utf-8')
+            index['names'].append(textfile)
+            index['offsets'].append(packout.tell())
+            index['lengths'].append(len(text))
+            index['md5s'].append(md5(textcontents).hexdigest())
+            index['sizes'].append(stat.st_size)
+            index['mtimes'].append(stat.st_mtime)
+            packout.write(text)
+            print_progress(cur, total, cur, t0, 'pack-corpus')
+    with open(packfile + '.index', 'wb') as indexout:
+        indexout.write(PACKED_CORPUS_MAGIC)
+        marshal.dump(index, indexout, 2)
+
+class PostingStore(KeyedStore):
+    """
+    The postings of each token of a CorpusIndex: a tuple of the numbers of
+    the files it occurs in and a list of its positions in each of them
+    """
+
+    loads = staticmethod(marshal.loads)
+
+class PostingStoreWriter(KeyedStoreWriter):
+
+    dumps = staticmethod(lambda value: marshal.dumps(value, 2))
+
+class CorpusIndex(object):
+    """
+    Where each word token occurs in a corpus, written by `index_corpus`.
+
+    Tokens are the runs of WORD_CHARS, so a pattern string that `\\b`
+    delimits consists of whole tokens, one right after the other. The
+    postings are in a PostingStore at `indexfile`, the corpus and its
+    files, with their md5 when they were indexed, in `<indexfile>.files`.
+    """
+
+    def __init__(self, indexfile):
+        with open(indexfile + '.files', 'rb') as filesin:
+            if filesin.read(len(CORPUS_INDEX_MAGIC)) != CORPUS_INDEX_MAGIC:
+                raise ValueError("Not a corpus index: %s.files" % indexfile)
+            files = marshal.loads(filesin.read())
+        self.textdir = files['textdir']
+        self.names = files['names']
+        self.md5s = files['md5s']
+        self.postings = PostingStore(indexfile)
+        self.cache = {}
+        self.cached_bytes = 0
+
+    def size(self, token):
+        """
+        Bytes of the stored postings of `token`, a measure of its frequency
+        """
+        return self.postings.index.get(token, (0, 0))[1]
+
+    def postings_of(self, token):
+        """
+        {file number: positions} of `token`
+        """
+        if token not in self.cache:
+            if self.cached_bytes > POSTINGS_CACHE_BYTES:
+                self.cache.clear()
+                self.cached_bytes = 0
+            file_nos, positions = self.postings.get(token, ((), ()))
+            self.cache[token] = dict(itertools.izip(file_nos, positions))
+            self.cached_bytes += self.size(token)
+        return self.cache[token]
+
+    def phrase_files(self, tokens):
+        """
+        The numbers of the files in which `tokens` occur one right after the
+        other, rarest token first so that a missing one ends the search
+        early
+        """
+        files = None
+        for token in sorted(set(tokens), key=self.size):
+            postings = self.postings_of(token)
+            files = set(postings) if files is None else files.intersection(postings)
+            if not files:
+                return []
+        result = []
+        for file_no in files:
+            starts = set(self.postings_of(tokens[0])[file_no])
+            for offset, token in enumerate(tokens[1:], 1):
+                starts.intersection_update(
+                        pos - offset for pos in self.postings_of(token)[file_no])
+                if not starts:
+                    break
+            if starts:
+                result.append(file_no)
+        return result
+
+    def candidates(self, matcher):
+        """
+        {file number: keywords of `matcher` that may occur in the file}.
+        Keywords without whole tokens to look up are candidates everywhere.
+        """
+        candidates = {}
+        everywhere = []
+        for keyword, keyword_no in matcher.keywords.iteritems():
+            tokens = TOKEN_RE.findall(keyword)
+            if matcher.entries[keyword_no][3]:
+                # without \b around it, the first and last token of the
+                # keyword may be part of a longer token in the text
+                if keyword[:1] in WORD_CHARS:
+                    tokens = tokens[1:]
+                if keyword[-1:] in WORD_CHARS:
+                    tokens = tokens[:-1]
+            if not tokens:
+                everywhere.append(keyword)
+                continue
+            for file_no in self.phrase_files(tokens):
+                candidates.setdefault(file_no, []).append(keyword)
+        if everywhere or matcher.regex_only:
+            logging.warn("%d patterns must be tried on every file" % (
+                len(everywhere) + len(matcher.regex_only)))
+            for file_no in range(len(self.names)):
+                candidates.setdefault(file_no, []).extend(everywhere)
+        return candidates
+
+def write_posting_run(run, runfile):
+    with open(runfile, 'wb') as runout:
+        for token in sorted(run):
+            file_nos, positions = run[token]
+            marshal.dump((token, file_nos, positions), runout, 2)
+
+def iter_posting_run(runfile):
+    with open(runfile, 'rb') as runin:
+        while True:
+            try:
+                yield marshal.load(runin)
+            except EOFError:
+                return
+
+def index_corpus(textdir, indexfile, tmpdir=None):
+    """
+    Index the word tokens of the texts in `textdir` (directory or packed
+    corpus) in `indexfile`, see CorpusIndex.
+
+    The postings are collected in sorted runs of INDEX_RUN_POSTINGS token
+    occurrences on disk, which are merged in the end, so memory stays
+    bounded for any size of corpus.
+    """
+    corpus = open_corpus(textdir)
+    files = {'textdir': textdir, 'names': corpus.names, 'md5s': []}
+    total = len(corpus.names)
+    t0 = time.time()
+    tmpdir = tempfile.mkdtemp(prefix='index-corpus-', dir=tmpdir)
+    try:
+        runs = []
+        run = {}
+        run_postings = 0
+        occurrences = 0
+        for file_no, textfile in enumerate(corpus.names):
+            textcontents, digest = corpus.read(textfile)
+            files['md5s'].append(digest)
+            with METRICS.stage('tokenize'):
+                tokens = TOKEN_RE.findall(textcontents)
+                positions = {}
+                for pos, token in enumerate(tokens):
+                    positions.setdefault(token, []).append(pos)
+                for token, token_positions in positions.iteritems():
+                    postings = run.get(token)
+                    if postings is None:
+                        postings = run[token] = ([], [])
+                    postings[0].append(file_no)
+                    postings[1].append(token_positions)
+            run_postings += len(tokens)
+            occurrences += len(tokens)
+            if run_postings >= INDEX_RUN_POSTINGS:
+                runs.append(os.path.join(tmpdir, 'run-%d' % len(runs)))
+                write_posting_run(run, runs[-1])
+                run = {}
+                run_postings = 0
+            print_progress(file_no + 1, total, occurrences, t0, 'index-corpus')
+        if run or not runs:
+            runs.append(os.path.join(tmpdir, 'run-%d' % len(runs)))
+            write_posting_run(run, runs[-1])
+        del run
+        logging.debug("Merging %d sorted runs into %s" % (len(runs), indexfile))
+        store = PostingStoreWriter(indexfile)
+        # the runs hold consecutive ranges of files, so merging them in
+        # order keeps the postings of a token sorted by file number
+        merged = heapq.merge(*[iter_posting_run(runfile) for runfile in runs])
+        with METRICS.stage('write'):
+            for token, postings in itertools.groupby(merged, lambda posting: posting[0]):
+                file_nos = []
+                positions = []
+                for token, run_file_nos, run_positions in postings:
+                    file_nos.extend(run_file_nos)
+                    positions.extend(run_positions)
+                store.add(token, (file_nos, positions))
+            store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    with open(indexfile + '.files', 'wb') as filesout:
+        filesout.write(CORPUS_INDEX_MAGIC)
+        marshal.dump(files, filesout, 2)
+    logging.info("Indexed %d tokens in %d files" % (len(store.index), total))
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Do the work
+#{{{
+
+class Prefetcher(object):
+    """
+    Yield `load(item)` for each of `items`, in order, loaded ahead by
+    `threads` reader threads.
+
+    A feeder thread puts a slot per item into a queue of at most `depth`
+    slots and hands it to the readers, which fill it. The consumer takes
+    the slots from the queue in order and waits for each to be filled, so
+    no more than `depth` + 1 loaded items are held at a time.
+    """
+
+    def __init__(self, load, items, threads, depth):
+        self.load = load
+        self.slots = Queue.Queue(max(1, depth))
+        self.tasks = Queue.Queue()
+        self.stopping = False
+        self.threads = [threading.Thread(target=self._feed, args=(items, threads))]
+        self.threads.extend(threading.Thread(target=self._read) for x in range(threads))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _feed(self, items, threads):
+        try:
+            for item in items:
+                # item, filled, loaded, exception info
+                slot = [item, threading.Event(), None, None]
+                self.slots.put(slot)
+                if self.stopping:
+                    break
+                self.tasks.put(slot)
+        finally:
+            for x in range(threads):
+                self.tasks.put(None)
+            if not self.stopping:
+                self.slots.put(None)
+
+    def _read(self):
+        while True:
+            slot = self.tasks.get()
+            if slot is None:
+                return
+            try:
+                slot[2] = self.load(slot[0])
+            except Exception:
+                slot[3] = sys.exc_info()
+            slot[1].set()
+
+    def __iter__(self):
+        try:
+            while True:
+                slot = self.slots.get()
+                if slot is None:
+                    return
+                slot[1].wait()
+                if slot[3]:
+                    raise slot[3][0], slot[3][1], slot[3][2]
+                yield slot[2]
+        finally:
+            # let the feeder see that it must stop
+            self.stopping = True
+            try:
+                while True:
+                    self.slots.get_nowait()
+            except Queue.Empty:
+                pass
+
+def load_file(corpus, metadata, textfile):
+    """
+    Everything `search_file` needs to read for `textfile`: its stat, its
+    contents and md5, what `metadata` prefetches for it and how many
+    seconds that took.
+
+    The contents are None for a file over the FILE_BUDGET and for a file
+    of a directory larger than TEXT_WINDOW_BYTES, which `search_file`
+    reads in windows while it searches it.
+    """
+    t0 = time.time()
+    stat = corpus.stat(textfile)
+    if FILE_BUDGET['bytes'] and stat[0] > FILE_BUDGET['bytes'] or \
+            stat[0] > TEXT_WINDOW_BYTES and isinstance(corpus, DirectoryCorpus):
+        contents = None
+    else:
+        contents = corpus.read(textfile)
+    prefetched = metadata.prefetch(textfile)
+    return textfile, stat, contents, prefetched, time.time() - t0
+
+def iter_load_files(corpus, metadata, textfiles, prefetch=0, queue_depth=None):
+    """
+    Yield `load_file` for each of `textfiles`, in order, loaded ahead by
+    `prefetch` reader threads if there are any
+    """
+    load = lambda textfile: load_file(corpus, metadata, textfile)
+    if prefetch <= 0:
+        return itertools.imap(load, textfiles)
+    return iter(Prefetcher(load, textfiles, prefetch,
+        queue_depth or prefetch * PREFETCH_DEPTH_PER_THREAD))
+
+def search_file(matcher, loaded, metadata, known=None):
+    """
+    Search one text file, as loaded by `load_file`, and return its record
+    for the run manifest. The entity the file manifests is only made from
+    `metadata` if something was found.
+
+    `known` maps md5s of texts that were already searched with the same
+    patterns to their manifest record, whose result is reused.
+    """
+    t0 = time.time()
+    textfile, (size, mtime), contents, prefetched, load_seconds = loaded
+    record = {
+        'file': textfile,
+        'size': size,
+        'mtime': mtime,
+    }
+    deadline = None
+    if FILE_BUDGET['seconds']:
+        deadline = t0 - load_seconds + FILE_BUDGET['seconds']
+    try:
+        if FILE_BUDGET['bytes'] and size > FILE_BUDGET['bytes']:
+            raise FileBudgetError("larger than %d bytes" % FILE_BUDGET['bytes'])
+        if contents is None:
+            digest = md5()
+            with open(textfile, 'rb') as textin:
+                record['found'] = matcher.search_windows(
+                        iter_windows(textin, digest, matcher.window_overlap()), deadline)
+            record['md5'] = digest.hexdigest()
+        else:
+            textcontents, record['md5'] = contents
+            if known and record['md5'] in known:
+                record['found'] = known[record['md5']]['found']
+            else:
+                record['found'] = matcher.search(textcontents, deadline)
+    except FileBudgetError, e:
+        logging.warn("Skipping %s: %s" % (textfile, e))
+        record['found'] = []
+        record['md5'] = None
+        record['skipped'] = str(e)
+    if record['found']:
+        with METRICS.stage('metadata'):
+            record['entity'] = metadata.entity(textfile, prefetched)
+    if METRICS.enabled:
+        METRICS.add_file(textfile, load_seconds + time.time() - t0)
+    return record
+
+def search_chunk(chunk):
+    """
+    Search a list of text files in a worker process, return their records
+    and the metrics collected meanwhile
+    """
+    matcher = WORKER_STATE['matcher']
+    corpus = WORKER_STATE['corpus']
+    metadata = WORKER_STATE['metadata']
+    known = WORKER_STATE['known']
+    METRICS.reset()
+    records = [search_file(matcher, loaded, metadata, known) for loaded
+            in iter_load_files(corpus, metadata, chunk, *WORKER_STATE['prefetch'])]
+    return records, METRICS.state()
+
+def chunk_by_size(corpus, textfiles, nchunks):
+    """
+    Split `textfiles` into consecutive chunks of roughly equal total size.
+    A file larger than the target size gets a chunk of its own.
+    """
+    sizes = [corpus.stat(textfile)[0] for textfile in textfiles]
+    target = max(1, sum(sizes) / max(1, nchunks))
+    chunk = []
+    chunk_size = 0
+    for textfile, size in itertools.izip(textfiles, sizes):
+        if chunk and chunk_size + size > target:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(textfile)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+def iter_search_files(matcher, corpus, textfiles, metadata, jobs=1, known=None,
+        prefetch=0, queue_depth=None):
+    """
+    Yield the record of each of `textfiles` in `corpus`, in order.
+
+    With `jobs` > 1 the files are searched by a pool of worker processes
+    that are forked after `matcher` was built, so they share it
+    copy-on-write instead of loading the pattern set again. Each process
+    has its own `prefetch` reader threads, see `iter_load_files`.
+    """
+    if jobs <= 1:
+        for loaded in iter_load_files(corpus, metadata, textfiles, prefetch, queue_depth):
+            yield search_file(matcher, loaded, metadata, known)
+        return
+    WORKER_STATE['matcher'] = matcher
+    WORKER_STATE['corpus'] = corpus
+    WORKER_STATE['metadata'] = metadata
+    WORKER_STATE['known'] = known
+    WORKER_STATE['prefetch'] = (prefetch, queue_depth)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunks = chunk_by_size(corpus, textfiles, jobs * CHUNKS_PER_JOB)
+        for results, metrics in pool.imap(search_chunk, chunks):
+            METRICS.merge(metrics)
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        WORKER_STATE.clear()
+
+def iter_search_results(matcher, corpus, metadata, jobs=1, manifest=None,
+        prefetch=0, queue_depth=None, delta=None):
+    """
+    Yield the record of each text file in `corpus`, in order, taking those
+    that are unchanged since the last run from `manifest` and adding the
+    others to it.
+
+    With a PatternDelta, files that are unchanged since they were searched
+    with the previous pattern db are only searched for the patterns the
+    delta must rescan.
+    """
+    textfiles = corpus.names
+    if manifest is None:
+        for record in iter_search_files(matcher, corpus, textfiles, metadata, jobs,
+                None, prefetch, queue_depth):
+            yield record
+        return
+    reused = {}
+    previous = {}
+    for textfile in textfiles:
+        stat = corpus.stat(textfile)
+        record = manifest.lookup(textfile, stat)
+        if record is not None:
+            reused[textfile] = record
+        elif delta:
+            record = manifest.lookup(textfile, stat, previous=True)
+            if record is not None:
+                previous[textfile] = record
+    logging.info("%d files unchanged since the last run" % len(reused))
+    if delta:
+        logging.info("%d files unchanged since the run with the previous patterns" % len(previous))
+        rescanned = iter_search_files(delta.rescan_matcher, corpus,
+                [textfile for textfile in textfiles if textfile in previous], metadata, jobs,
+                None, prefetch, queue_depth)
+    pending = [textfile for textfile in textfiles if textfile not in reused and textfile not in previous]
+    searched = iter_search_files(matcher, corpus, pending, metadata, jobs, manifest.by_md5,
+            prefetch, queue_depth)
+    for textfile in textfiles:
+        if textfile in reused:
+            yield reused[textfile]
+            continue
+        if textfile in previous:
+            record = delta.apply(previous[textfile], next(rescanned), metadata)
+        else:
+            record = next(searched)
+        manifest.add(record)
+        yield record
+
+def write_links(matcher, record, outdbs, targets=None, summaries=None):
+    """
+    Write the entity of a searched file and its links to the output of the
+    pattern set they belong to, and the entities they link to if there are
+    `targets`, counting the links in the set's LinkSummary if there are
+    `summaries`
+    """
+    with METRICS.stage('write'):
+        # files without hits have no entity
+        escaped_from_id = urlescape(record['entity']['_id']) if record['found'] else None
+        for set_no, (outdb, found) in enumerate(zip(outdbs, matcher.split_by_set(record['found']))):
+            if found:
+                outdb.add('entity', record['entity']['_id'], record['entity'])
+            links = {} if summaries else None
+            for pat_idx in found:
+                make_entity_link_from_pattern(matcher, record['entity'], pat_idx, outdb, escaped_from_id,
+                        links)
+                if targets:
+                    for to_idx in matcher.link_to[pat_idx]:
+                        targets.add(set_no, outdb, matcher.entity_ids[to_idx])
+            if summaries:
+                summaries[set_no].add_entity_links(links)
+
+def corpus_name(metadir):
+    """
+    The name of a corpus, going by its metadata directory '<name>/meta'
+    """
+    return re.sub(".*/", "", re.sub("/meta(\.store)?$", "", metadir))
+
+def search_patterns_in_files(dbfiles, corpus, metadir, outdbs, jobs=1, manifestfile=None, resume=False,
+        prefetch=0, queue_depth=None, include_targets=False, delta=None, summaries=None,
+        hit_matrices=None):
+    """
+    Search `corpus` for the patterns of all `dbfiles` in one pass and write
+    the links for each pattern set to the corresponding one of `outdbs`,
+    counting them in the corresponding one of `summaries` and adding the
+    patterns found to the corresponding one of `hit_matrices`, if given
+    """
+    idstr = ','.join(re.sub(".*/", "", dbfile) for dbfile in dbfiles) + '_' + corpus_name(metadir)
+    with METRICS.stage('load-patterns'):
+        matchers = [load_pattern_matcher(dbfile) for dbfile in dbfiles]
+        matcher = PatternMatcher.combine(matchers)
+    METRICS.pattern_ids = matcher.ids
+    shard_outputs = []
+    for outdb, set_matcher in zip(outdbs, matchers):
+        if isinstance(outdb, ShardOutput):
+            outdb.provenance['patterns_md5'] = set_matcher.source_md5
+            shard_outputs.append(outdb)
+    for hits, set_matcher in zip(hit_matrices or [], matchers):
+        hits.matcher = set_matcher
+    metadata = open_metadata(metadir)
+    targets = None
+    if include_targets:
+        targets = TargetEntities([open_target_entities(dbfile) for dbfile in dbfiles])
+    manifest = None
+    if delta:
+        delta.prepare(matcher)
+        manifest = RunManifest(manifestfile, matcher.source_md5, True, delta.old_md5)
+    elif manifestfile:
+        manifest = RunManifest(manifestfile, matcher.source_md5, resume)
+    cur = 0
+    total = len(corpus.names)
+    total_found = 0
+    logging.info("Start Searching %d files with %d job(s)" % (total, jobs))
+    t0 = time.time()
+    throughput = 0
+    try:
+        for record in iter_search_results(matcher, corpus, metadata, jobs, manifest,
+                prefetch, queue_depth, delta):
+            write_links(matcher, record, outdbs, targets, summaries)
+            if hit_matrices:
+                for set_no, found in enumerate(matcher.split_by_set(record['found'])):
+                    hit_matrices[set_no].add(record, found, matcher.set_starts[set_no])
+            for outdb in shard_outputs:
+                outdb.end_file(record['file'])
+            cur += 1
+            #  sys.stderr.write(CLEAR)
+            print_progress(cur, total, total_found, t0, idstr)
+            total_found += len(record['found'])
+    finally:
+        if manifest:
+            manifest.close()
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Match server
+#{{{
+
+class MatchService(object):
+    """
+    Pattern sets compiled once, answering for a document the entities and
+    links a search would write for it
+    """
+
+    def __init__(self, dbfiles):
+        self.dbfiles = dbfiles
+        self.matcher = PatternMatcher.combine([load_pattern_matcher(dbfile) for dbfile in dbfiles])
+
+    def info(self):
+        return {
+            'patterns': len(self.matcher.ids),
+            'entities': len(self.matcher.entity_ids),
+            'dbs': self.dbfiles,
+        }
+
+    def links(self, doc):
+        """
+        {db: {'entity': ..., 'entityLink': ...}} for `doc`, which is
+        {'text': text, 'meta': OAI-PMH XML, 'id': id} with 'meta' and 'id'
+        optional. Without 'meta' the entity is made from 'id', or the md5
+        of the text.
+        """
+        text = doc['text']
+        if doc.get('meta'):
+            meta = doc['meta']
+            if isinstance(meta, unicode):
+                meta = meta.encode('utf-8')
+            entity = make_entity_from_oai(io.BytesIO(meta))
+        else:
+            _id = doc.get('id') or md5(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+            entity = {'_id': 'entity_' + urlescape(_id), 'entityType': 'publication'}
+        outdbs = [JsonOutput(None) for dbfile in self.dbfiles]
+        write_links(self.matcher, {'found': self.matcher.search(text), 'entity': entity}, outdbs)
+        return dict((dbfile, outdb.db) for dbfile, outdb in zip(self.dbfiles, outdbs))
+
+class MatchHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST a document as text/plain, or one or more as JSON objects, one per
+    line, and get the result for each, one JSON line each. GET tells what
+    patterns are loaded.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one write, or the client may wait for a
+    # delayed ACK on every keep-alive request
+    wbufsize = -1
+
+    def do_GET(self):
+        self.reply(200, json.dumps(self.server.service.info(), sort_keys=True) + "\n")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        try:
+            if self.headers.gettype() == 'text/plain':
+                docs = [{'text': body}]
+            else:
+                docs = [json.loads(line) for line in body.splitlines() if line.strip()]
+            results = [self.server.service.links(doc) for doc in docs]
+        except Exception, e:
+            # whatever a document breaks, the server keeps answering
+            logging.warn("Bad document from %s: %r" % (self.address_string(), e))
+            self.reply(400, json.dumps({'error': repr(e)}) + "\n")
+            return
+        self.reply(200, "".join(json.dumps(result, sort_keys=True) + "\n" for result in results))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+class MatchStreamHandler(SocketServer.StreamRequestHandler):
+    """
+    Read documents as JSON lines, one object or a list of them per line,
+    and answer each line with a line of the results
+    """
+
+    def handle(self):
+        service = self.server.service
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if isinstance(request, list):
+                    result = [service.links(doc) for doc in request]
+                else:
+                    result = service.links(request)
+            except Exception, e:
+                # answer the line with the error and keep the session
+                logging.warn("Bad document on %s: %r" % (self.server.server_address, e))
+                result = {'error': repr(e)}
+            self.wfile.write(json.dumps(result, sort_keys=True) + "\n")
+            self.wfile.flush()
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve(dbfiles, socketpath=None, host=SERVE_HOST, port=SERVE_PORT):
+    """
+    Answer documents with their links until interrupted, over HTTP or, if
+    `socketpath` is given, a Unix socket, one thread per client
+    """
+    service = MatchService(dbfiles)
+    if socketpath:
+        if os.path.exists(socketpath):
+            os.unlink(socketpath)
+        server = ThreadingUnixServer(socketpath, MatchStreamHandler)
+        logging.info("Serving %d patterns on %s" % (len(service.matcher.ids), socketpath))
+    else:
+        server = ThreadingHTTPServer((host, port), MatchHTTPHandler)
+        logging.info("Serving %d patterns on http://%s:%d/" % (len(service.matcher.ids), host, port))
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketpath and os.path.exists(socketpath):
+            os.unlink(socketpath)
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# Harvest and upload
+# {{{
+
+class HttpError(Exception):
+    pass
+
+class HttpClient(object):
+    """
+    Send requests to the host of `url` over a pool of connections kept open
+    between requests, as many as threads send at once.
+
+    A request that fails is tried again, up to HTTP_RETRIES times, unless
+    the server refused it (a 4xx status other than 429). `stop` wakes the
+    threads waiting to try again.
+    """
+
+    def __init__(self, url):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _connection(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=HTTP_TIMEOUT)
+        return httplib.HTTPConnection(self.netloc, timeout=HTTP_TIMEOUT)
+
+    def request(self, method, url, body=None, headers={}):
+        """
+        The body of the 2xx response to `method` `url`, or None if stopped
+        before trying again
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        for attempt in range(HTTP_RETRIES):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                # read it all, for the connection to be used again
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                error = str(e) or e.__class__.__name__
+                connection.close()
+            else:
+                with self.lock:
+                    self.idle.append(connection)
+                if 200 <= response.status < 300:
+                    return data
+                error = "HTTP %d %s" % (response.status, response.reason)
+                if response.status < 500 and response.status != 429:
+                    raise HttpError("%s: %s" % (url, error))
+            if attempt + 1 == HTTP_RETRIES:
+                raise HttpError("%s: %s, giving up after %d tries" % (url, error, HTTP_RETRIES))
+            delay = HTTP_BACKOFF * 2 ** attempt
+            logging.warning("%s: %s, trying again in %g seconds" % (url, error, delay))
+            if self.stopped.wait(delay):
+                return None
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+def dara_page_records(body):
+    """
+    The number of <doc>s in a page of da-ra solr XML and the number of docs
+    the query found in all
+    """
+    found = re.search(r'numFound="(\d+)"', body)
+    return len(SOLR_DOC_START_RE.findall(body)), int(found.group(1)) if found else None
+
+def icpsr_page_records(body):
+    """
+    The number of studies in a page of ICPSR CSV, without its header and
+    blank lines, and None for the number in all, which it does not tell
+    """
+    rows = sum(1 for row in csv.reader(io.BytesIO(body)) if row)
+    return max(0, rows - 1), None
+
+# source -> default URL, page file suffix, records of a page
+HARVEST_SOURCES = {
+    'dara': (DARA_SOLR_URL, '.xml', dara_page_records),
+    'icpsr': (ICPSR_STUDIES_URL, '.csv', icpsr_page_records),
+}
+
+class Harvester(object):
+    """
+    Download the pages of a source to `pagedir` and yield their files in
+    order, each as soon as it and the pages before it are complete, so they
+    can be converted while later pages are downloading.
+
+    Page n holds the `rows` records from record n * `rows` on. `threads`
+    threads download the pages with one HttpClient. The pages end with
+    the number of records the first one reports, or with the first one
+    holding fewer than `rows` records.
+
+    Each complete page is recorded in <pagedir>/harvest.manifest, one JSON
+    line per page. With `resume`, the pages recorded there for the same
+    URL and rows are not downloaded again.
+    """
+
+    def __init__(self, source, pagedir, url=None, rows=HARVEST_ROWS, threads=HARVEST_THREADS,
+            resume=False):
+        default_url, self.suffix, self.page_records = HARVEST_SOURCES[source]
+        self.url = url or default_url
+        self.client = HttpClient(self.url)
+        self.rows = rows
+        self.threads = threads
+        self.pagedir = pagedir
+        self.lock = threading.Condition()
+        # page number -> manifest record, for complete pages
+        self.done = {}
+        # records of the source in all, once a page tells
+        self.total = None
+        # the first page past the last, once known
+        self.end = None
+        self.next_page = 0
+        self.stopping = False
+        # exception info of a failed download thread
+        self.failed = None
+        if not os.path.isdir(pagedir):
+            os.makedirs(pagedir)
+        manifestfile = os.path.join(pagedir, 'harvest.manifest')
+        self.manifestout, records = open_json_lines(manifestfile, resume, {'url': self.url, 'rows': rows})
+        for record in records:
+            pagefile = os.path.join(pagedir, record['file'])
+            if os.path.exists(pagefile) and os.path.getsize(pagefile) == record['bytes']:
+                self._page_done(record['start'] // rows, record)
+        if resume:
+            logging.info("Resuming with %d pages from %s" % (len(self.done), manifestfile))
+
+    def _page_done(self, page, record):
+        self.done[page] = record
+        if record['total'] is not None:
+            self.total = record['total']
+            self._end_at(max(1, -(-record['total'] // self.rows)))
+        if record['records'] < self.rows:
+            self._end_at(page + 1)
+
+    def _end_at(self, page):
+        if self.end is None or page < self.end:
+            self.end = page
+
+    def _download(self):
+        try:
+            while True:
+                with self.lock:
+                    page = self.next_page
+                    while page in self.done:
+                        page += 1
+                    if self.stopping or self.failed or self.end is not None and page >= self.end:
+                        return
+                    self.next_page = page + 1
+                self._download_page(page)
+        except Exception:
+            with self.lock:
+                self.failed = self.failed or sys.exc_info()
+                self.lock.notify_all()
+
+    def _download_page(self, page):
+        start = page * self.rows
+        body = self.client.request('GET', self.url.format(start=start, rows=self.rows))
+        if body is None:
+            # stopped
+            return
+        records, total = self.page_records(body)
+        name = 'page-%09d%s' % (start, self.suffix)
+        pagefile = os.path.join(self.pagedir, name)
+        with open(pagefile + '.tmp', 'wb') as pageout:
+            pageout.write(body)
+        os.rename(pagefile + '.tmp', pagefile)
+        record = {'url': self.url, 'rows': self.rows, 'start': start, 'file': name,
+                'bytes': len(body), 'records': records, 'total': total}
+        with self.lock:
+            self.manifestout.write(json.dumps(record, sort_keys=True) + "\n")
+            self.manifestout.flush()
+            self._page_done(page, record)
+            self.lock.notify_all()
+
+    def __iter__(self):
+        threads = [threading.Thread(target=self._download) for x in range(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        page = 0
+        try:
+            while True:
+                with self.lock:
+                    while not (self.end is not None and page >= self.end or page in self.done
+                            or self.failed):
+                        self.lock.wait()
+                    if self.end is not None and page >= self.end:
+                        break
+                    if page not in self.done:
+                        raise self.failed[0], self.failed[1], self.failed[2]
+                    pagefile = os.path.join(self.pagedir, self.done[page]['file'])
+                yield pagefile
+                page += 1
+        finally:
+            with self.lock:
+                self.stopping = True
+                self.lock.notify_all()
+            self.client.stop()
+            # pages still downloading are recorded for a later --resume
+            for thread in threads:
+                thread.join()
+            self.client.close()
+            self.manifestout.close()
+
+class Uploader(object):
+    """
+    POST the entries of the UPLOAD_SECTIONS of a db to `url` in batches of
+    `batch_size`, each batch a JSON db of its own, {section: {key: value}},
+    sent by `threads` threads with one HttpClient. Of several entries with
+    the same _id (or key, for values without one) in a section, only the
+    first is sent.
+
+    Each batch sent is recorded in `checkpointfile`, one JSON line per
+    batch. Batches are numbered in the order they are read from the db.
+    With `resume`, the batches recorded there for the same db, URL and
+    batch size are not sent again.
+    """
+
+    def __init__(self, dbfile, url=UPLOAD_URL, batch_size=UPLOAD_BATCH_SIZE,
+            threads=UPLOAD_THREADS, checkpointfile=None, resume=False):
+        self.dbfile = dbfile
+        self.url = url
+        self.client = HttpClient(url)
+        self.batch_size = batch_size
+        self.threads = threads
+        stat = os.stat(dbfile)
+        # what the batches recorded in the checkpoint must have been sent from
+        self.source = {'db': os.path.abspath(dbfile), 'size': stat.st_size,
+                'mtime': stat.st_mtime, 'url': url, 'batch_size': batch_size}
+        self.lock = threading.Lock()
+        # numbers of the batches sent
+        self.done = set()
+        self.read = 0
+        self.duplicates = 0
+        self.resumed = 0
+        self.sent = 0
+        self.batches = 0
+        self.bytes = 0
+        self.stopping = False
+        # exception info of a failed sending thread
+        self.failed = None
+        checkpointfile = checkpointfile or dbfile + '.upload'
+        self.checkpointout, records = open_json_lines(checkpointfile, resume, self.source)
+        self.done.update(record['batch'] for record in records)
+        if resume:
+            logging.info("Resuming with %d batches from %s" % (len(self.done), checkpointfile))
+
+    def _batches(self):
+        """
+        Yield lists of up to `batch_size` (section, key, value) entries to send
+        """
+        # digests of section and _id, to keep the set small
+        seen = set()
+        batch = []
+        for section, key, value in iter_db_entries(self.dbfile):
+            if section not in UPLOAD_SECTIONS:
+                continue
+            self.read += 1
+            _id = value.get('_id', key) if isinstance(value, dict) else key
+            digest = md5(json.dumps([section, _id])).digest()
+            if digest in seen:
+                self.duplicates += 1
+                continue
+            seen.add(digest)
+            batch.append((section, key, value))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _send(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if self.stopping or self.failed:
+                continue
+            batch_no, batch = task
+            db = {}
+            for section, key, value in batch:
+                db.setdefault(section, {})[key] = value
+            data = json.dumps(db)
+            try:
+                if self.client.request('POST', self.url, data,
+                        {'Content-Type': 'application/json'}) is None:
+                    # stopped
+                    continue
+            except Exception:
+                with self.lock:
+                    self.failed = self.failed or sys.exc_info()
+                self.client.stop()
+                continue
+            record = dict(self.source, batch=batch_no, entries=len(batch), bytes=len(data))
+            with self.lock:
+                self.checkpointout.write(json.dumps(record, sort_keys=True) + "\n")
+                self.checkpointout.flush()
+                self.sent += len(batch)
+                self.batches += 1
+                self.bytes += len(data)
+
+    def run(self):
+        # batches read ahead of the sending threads
+        tasks = Queue.Queue(self.threads * 2)
+        threads = [threading.Thread(target=self._send, args=(tasks,)) for x in range(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        t0 = time.time()
+        try:
+            for batch_no, batch in enumerate(self._batches()):
+                if self.failed:
+                    break
+                if batch_no in self.done:
+                    self.resumed += len(batch)
+                    continue
+                tasks.put((batch_no, batch))
+                print_progress(self.resumed + self.sent, self.read - self.duplicates,
+                        self.batches, t0, 'upload')
+        except:
+            self.stopping = True
+            raise
+        finally:
+            if self.stopping or self.failed:
+                self.client.stop()
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+            self.client.close()
+            self.checkpointout.close()
+        if self.failed:
+            raise self.failed[0], self.failed[1], self.failed[2]
+        print_progress(self.resumed + self.sent, self.read - self.duplicates, self.batches, t0, 'upload')
+        sys.stderr.write("\n")
+        seconds = max(time.time() - t0, 1e-6)
+        logging.info("Uploaded %d entries in %d batches (%.1f MB) in %.1f seconds: %.1f entries/s, "
+                "%.2f MB/s; %d duplicates skipped, %d entries sent before" % (
+                self.sent, self.batches, self.bytes / 1e6, seconds, self.sent / seconds,
+                self.bytes / 1e6 / seconds, self.duplicates, self.resumed))
+
+#}}}
+
+#-----------------------------------------------------------------------------
+# CLI Commands
+#{{{ 
+
+def search_patterns(dbfiles, textdir, metadir, outdbfiles, jobs=1, manifestfile=None, resume=False,
+        prefetch=0, queue_depth=None, include_targets=False, shard=None, deltafile=None,
+        hit_matrix=False):
+    corpus = open_corpus(textdir)
+    logging.info("Number of text files: %d" % len(corpus.names))
+    if manifestfile is None:
+        manifestfile = outdbfiles[0] + '.manifest'
+    outdbs = [open_db_output(outdbfile) for outdbfile in outdbfiles]
+    if shard:
+        corpus_names = corpus.names
+        # the rest of the search only sees the files of this shard
+        corpus.names = [name for name in corpus_names if in_shard(name, *shard)]
+        logging.info("Shard %d/%d has %d text files" % (shard + (len(corpus.names),)))
+        provenance = {
+            'shard': shard[0],
+            'shards': shard[1],
+            'corpus_md5': names_md5(corpus_names),
+            'corpus_files': len(corpus_names),
+            'files_md5': names_md5(corpus.names),
+            'files': len(corpus.names),
+            'include_targets': include_targets,
+        }
+        outdbs = [ShardOutput(outdb, outdbfile, provenance, corpus_names)
+                for outdb, outdbfile in zip(outdbs, outdbfiles)]
+    delta = PatternDelta(deltafile) if deltafile else None
+    summaries = [LinkSummary(corpus_name(metadir)) for outdbfile in outdbfiles]
+    hit_matrices = [HitMatrix() for outdbfile in outdbfiles] if hit_matrix else None
+    search_patterns_in_files(dbfiles, corpus, metadir, outdbs, jobs, manifestfile, resume,
+            prefetch, queue_depth, include_targets, delta, summaries, hit_matrices)
+    logging.info("Finished matching, writing out")
+    for outdb, outdbfile, summary in zip(outdbs, outdbfiles, summaries):
+        outdb.close()
+        summary.save(outdbfile + '.summary.json')
+    for hits, outdbfile in zip(hit_matrices or [], outdbfiles):
+        hits.save(outdbfile + '.hits.npz')
+
+def query_patterns(dbfiles, indexfile, metadir, outdbfiles):
+    """
+    Find the patterns of `dbfiles` in the corpus indexed in `indexfile`,
+    reading only the files the index says may contain one
+    """
+    matcher = PatternMatcher.combine([load_pattern_matcher(dbfile) for dbfile in dbfiles])
+    METRICS.pattern_ids = matcher.ids
+    corpus_index = CorpusIndex(indexfile)
+    corpus = open_corpus(corpus_index.textdir)
+    metadata = open_metadata(metadir)
+    with METRICS.stage('postings'):
+        candidates = corpus_index.candidates(matcher)
+    logging.info("%d of %d files may contain a pattern" % (
+        len(candidates), len(corpus_index.names)))
+    outdbs = [open_db_output(outdbfile) for outdbfile in outdbfiles]
+    summaries = [LinkSummary(corpus_name(metadir)) for outdbfile in outdbfiles]
+    total = len(candidates)
+    total_found = 0
+    t0 = time.time()
+    for cur, file_no in enumerate(sorted(candidates), 1):
+        textfile = corpus_index.names[file_no]
+        textcontents, digest = corpus.read(textfile)
+        if digest != corpus_index.md5s[file_no]:
+            logging.warn("%s changed since it was indexed" % textfile)
+        found = matcher.confirm(textcontents, candidates[file_no], bool(matcher.regex_only))
+        if found:
+            with METRICS.stage('metadata'):
+                entity = metadata.entity(textfile)
+            write_links(matcher, {'found': found, 'entity': entity}, outdbs, summaries=summaries)
+        total_found += len(found)
+        print_progress(cur, total, total_found, t0, 'query-patterns')
+    logging.info("Finished matching, writing out")
+    for outdb, outdbfile, summary in zip(outdbs, outdbfiles, summaries):
+        outdb.close()
+        summary.save(outdbfile + '.summary.json')
+
+def summarize(dbfiles, top=SUMMARY_TOP, by_pattern=False):
+    """
+    Print the link counts of the outputs `dbfiles`, taken from the
+    '<db>.summary.json' a search wrote along with an output if it is not
+    older than the output, counted from the output otherwise. With
+    `by_pattern` only the count per pattern, most frequent last.
+    """
+    summary = LinkSummary()
+    for dbfile in dbfiles:
+        summaryfile = dbfile + '.summary.json'
+        if os.path.exists(summaryfile) and os.path.getmtime(summaryfile) >= os.path.getmtime(dbfile):
+            with open(summaryfile) as summaryin:
+                summary.update(json.load(summaryin))
+        else:
+            logging.info("Counting the links of %s" % dbfile)
+            # link ids are only unique within one output
+            db_summary = LinkSummary()
+            db_summary.add_db(dbfile)
+            summary.update(db_summary.as_dict())
+    if by_pattern:
+        for reason, count in sorted(summary.patterns.iteritems(), key=lambda (reason, count): (count, reason)):
+            sys.stdout.write((u"%7d %s\n" % (count, reason)).encode('utf-8'))
+    else:
+        sys.stdout.write(json.dumps(summary.as_dict(top), indent=2, sort_keys=True) + "\n")
+
+def rescore(outdbfile, newoutdbfile, weight='split', min_confidence=0.0, max_df=None, min_patterns=1):
+    """
+    Write the links of the search output `outdbfile` to `newoutdbfile`
+    with their confidence computed anew from its hit matrix
+    (`<outdbfile>.hits.npz`, see HitMatrix), without reading any text.
+
+    A pattern linking to n entities gives each a confidence of 1/n, with
+    `weight` 'idf' multiplied by log(files / files with the pattern) /
+    log(files). Patterns found in more than the share `max_df` of the
+    files are dropped. A link gets the highest confidence of the patterns
+    it is made from and is only kept if that is at least `min_confidence`
+    and it is made from at least `min_patterns` patterns.
+    """
+    hits = numpy.load(outdbfile + '.hits.npz')
+    indptr = hits['indptr']
+    patterns = hits['indices']
+    rows = numpy.repeat(numpy.arange(len(indptr) - 1), numpy.diff(indptr))
+    files = int(hits['files_searched'])
+    link_indptr = hits['link_indptr']
+    targets_per_pattern = numpy.diff(link_indptr)
+    files_per_pattern = numpy.bincount(patterns, minlength=len(targets_per_pattern))
+    weights = 1.0 / numpy.maximum(targets_per_pattern, 1)
+    if weight == 'idf':
+        weights *= numpy.log(float(files) / numpy.maximum(files_per_pattern, 1)) / numpy.log(max(files, 2))
+    if max_df is not None:
+        keep = (files_per_pattern <= max_df * files)[patterns]
+        rows = rows[keep]
+        patterns = patterns[keep]
+        logging.info("Dropped %d patterns found in more than %g of %d files" % (
+            numpy.count_nonzero(files_per_pattern > max_df * files), max_df, files))
+    # one (row, pattern, target) per link a pattern makes
+    counts = targets_per_pattern[patterns]
+    link_rows = numpy.repeat(rows, counts)
+    link_patterns = numpy.repeat(patterns, counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    link_targets = hits['link_indices'][numpy.repeat(link_indptr[patterns], counts) + offsets]
+    confidences = weights[link_patterns]
+    # the links from a row to a target end with the most confident one, the
+    # last pattern among equals as in the search output
+    order = numpy.lexsort((confidences, link_targets, link_rows))
+    link_rows = link_rows[order]
+    link_patterns = link_patterns[order]
+    link_targets = link_targets[order]
+    confidences = confidences[order]
+    last = numpy.ones(len(order), dtype=bool)
+    last[:-1] = (link_rows[1:] != link_rows[:-1]) | (link_targets[1:] != link_targets[:-1])
+    ends = numpy.flatnonzero(last)
+    support = numpy.diff(numpy.concatenate(([-1], ends)))
+    all_links = len(ends)
+    ends = ends[(confidences[ends] >= min_confidence) & (support >= min_patterns)]
+    logging.info("%d of %d links kept" % (len(ends), all_links))
+
+    from_ids = [entity_id.decode('utf-8') for entity_id in hits['entities']]
+    to_ids = [entity_id.decode('utf-8') for entity_id in hits['entity_ids']]
+    regexes = [regex.decode('utf-8') for regex in hits['pattern_regexes']]
+    linked_rows = numpy.unique(link_rows[ends])
+    wanted = set(from_ids[row] for row in linked_rows)
+    entities = {}
+    for section, key, value in iter_db_entries(outdbfile):
+        if section == 'entity' and key in wanted:
+            entities[key] = value
+    outdb = open_db_output(newoutdbfile)
+    for row in linked_rows:
+        outdb.add('entity', from_ids[row], entities[from_ids[row]])
+    escaped_from_ids = dict((row, urlescape(from_ids[row])) for row in linked_rows)
+    escaped_to_ids = dict((to_idx, urlescape(to_ids[to_idx])) for to_idx in numpy.unique(link_targets[ends]))
+    for row, to_idx, pat_idx, conf in itertools.izip(link_rows[ends], link_targets[ends],
+            link_patterns[ends], confidences[ends]):
+        outdb.add('entityLink', 'link_%s_%s' % (escaped_from_ids[row], escaped_to_ids[to_idx]), {
+            'confidence': float(conf),
+            'linkReason': regexes[pat_idx],
+            'entityRelations': ['matches_pattern'],
+            'fromEntity': from_ids[row],
+            'toEntity': to_ids[to_idx]
+        })
+    outdb.close()
+
+def merge_shards(outdbfile, shardfiles):
+    """
+    Combine the outputs of all shards of a `search-patterns --shard` run
+    into what a run without --shard would have written, after checking
+    that they come from the same corpus and patterns and that none is
+    missing
+    """
+    provenances = []
+    for shardfile in shardfiles:
+        try:
+            with open(shardfile + '.shard') as shardin:
+                provenances.append(json.load(shardin))
+        except IOError, e:
+            raise ShardError("%s is not the output of a --shard run: %s" % (shardfile, e))
+    first = provenances[0]
+    for shardfile, provenance in zip(shardfiles, provenances):
+        for key in ['shards', 'corpus_md5', 'patterns_md5', 'include_targets']:
+            if provenance[key] != first[key]:
+                raise ShardError("%s has %s %s, %s has %s" % (
+                    shardfile, key, provenance[key], shardfiles[0], first[key]))
+    shards = sorted(provenance['shard'] for provenance in provenances)
+    if shards != range(1, first['shards'] + 1):
+        raise ShardError("Need shards 1 to %d once each, got %s" % (first['shards'], shards))
+    if sum(provenance['files'] for provenance in provenances) != first['corpus_files']:
+        raise ShardError("The shards have %d files, the corpus %d" % (
+            sum(provenance['files'] for provenance in provenances), first['corpus_files']))
+    outdb = open_db_output(outdbfile)
+    if all(re.search(r"\.ndjson(\.gz)?$", shardfile) for shardfile in shardfiles):
+        # replay the entries file by file in corpus order
+        entries = [iter_ndjson(shardfile) for shardfile in shardfiles]
+        outputs = heapq.merge(*[[(file_no, shard_no, count) for file_no, count in provenance['output']]
+            for shard_no, provenance in enumerate(provenances)])
+        # with --include-targets each shard wrote a target entity right
+        # after its own first link to it: keep only the first, as
+        # TargetEntities does in a single run
+        linked = set()
+        targets = set()
+        for file_no, shard_no, count in outputs:
+            for x in range(count):
+                section, key, value = next(entries[shard_no])
+                if first['include_targets']:
+                    if section == 'entityLink':
+                        linked.add(value['toEntity'])
+                    elif section == 'entity' and key in linked:
+                        if key in targets:
+                            continue
+                        targets.add(key)
+                outdb.add(section, key, value)
+    elif isinstance(outdb, NdjsonOutput):
+        raise ShardError("Cannot restore the order of JSON shards in %s" % outdbfile)
+    else:
+        for shardfile in shardfiles:
+            for section, key, value in iter_db_entries(shardfile):
+                outdb.add(section, key, value)
+    outdb.close()
+
+def finalize_ndjson(ndjsonfile, outdbfile):
+    outdb = JsonOutput(outdbfile)
+    for section, key, value in iter_ndjson(ndjsonfile):
+        outdb.add(section, key, value)
+    outdb.close()
+
+def read_patterns(dbfile):
+    """
+    The 'infolisPattern' section of a JSON db, read entry by entry
+    """
+    patterns = {}
+    for section, key, value in iter_db_entries(dbfile):
+        if section == 'infolisPattern':
+            patterns[key] = value
+    return patterns
+
+def diff_patterns(olddbfile, newdbfile, deltafile):
+    """
+    Write the patterns added to, removed from and changed in `newdbfile`
+    compared to `olddbfile` to `deltafile`, with what `PatternDelta` needs
+    to update a search with the old patterns
+    """
+    old = read_patterns(olddbfile)
+    new = read_patterns(newdbfile)
+    delta = {
+        # the order of the pattern indexes in a search with the old patterns
+        'old': {'db': olddbfile, 'md5': file_md5(olddbfile), 'ids': list(old)},
+        'new': {'db': newdbfile, 'md5': file_md5(newdbfile)},
+        'added': dict((key, new[key]) for key in new if key not in old),
+        'removed': dict((key, old[key]) for key in old if key not in new),
+        'changed': dict((key, {'old': old[key], 'new': new[key]})
+            for key in new if key in old and new[key] != old[key]),
+    }
+    logging.info("%d patterns added, %d removed, %d changed" % (
+        len(delta['added']), len(delta['removed']), len(delta['changed'])))
+    with open(deltafile, 'w') as deltaout:
+        json.dump(delta, deltaout, indent=2, sort_keys=True)
+
+def compile_patterns(dbfile, indexfile):
+    matcher = compile_pattern_db(dbfile, indexfile + '.entities')
+    logging.info("Compiled %d patterns linking to %d entities" % (
+        len(matcher.ids), len(matcher.entity_ids)))
+    matcher.save(indexfile)
+
+def sample_hit_rates(patterns, sampledir, sample_size):
+    """
+    Search `sample_size` files evenly spread over the corpus `sampledir`
+    for `patterns` and return {key: share of the files it was found in}
+    for the patterns found at all
+    """
+    corpus = open_corpus(sampledir)
+    names = sorted(corpus.names)
+    sample = names[::max(1, len(names) / max(1, sample_size))][:sample_size]
+    matcher = PatternMatcher(patterns)
+    hits = [0] * len(matcher.ids)
+    t0 = time.time()
+    for cur, textfile in enumerate(sample, 1):
+        for idx in matcher.search(corpus.read(textfile)[0]):
+            hits[idx] += 1
+        print_progress(cur, len(sample), cur, t0, 'sample')
+    return dict((matcher.ids[idx], n * 1.0 / len(sample))
+            for idx, n in enumerate(hits) if n)
+
+def compact_patterns(dbfile, outdbfile, fold_case=False, sampledir=None,
+        sample_size=1000, max_hit_rate=0.05, drop=False, reportfile=None):
+    """
+    Write `dbfile` to `outdbfile` with its patterns compacted by
+    `compact_pattern_section` and, if `drop`, without those found in more
+    than `max_hit_rate` of a sample of the corpus `sampledir`
+    """
+    outdb = JsonDbWriter(outdbfile)
+    patterns = {}
+    for section, key, value in iter_db_entries(dbfile):
+        if section == 'infolisPattern':
+            patterns[key] = value
+        else:
+            outdb.add(section, key, value)
+    compacted = compact_pattern_section(patterns, fold_case)
+    logging.info("Compacted %d patterns to %d" % (len(patterns), len(compacted)))
+    if sampledir:
+        rates = sample_hit_rates(compacted, sampledir, sample_size)
+        frequent = sorted((key for key in rates if rates[key] > max_hit_rate),
+                key=lambda key: -rates[key])
+        logging.info("%d patterns are found in more than %.1f%% of the sample" % (
+            len(frequent), max_hit_rate * 100))
+        for key in frequent[:20]:
+            logging.info("%6.2f%% %s" % (rates[key] * 100, compacted[key]['_stringMatch']))
+        if reportfile:
+            with open(reportfile, 'w') as reportout:
+                json.dump(dict((key, {
+                    '_stringMatch': compacted[key].get('_stringMatch'),
+                    'linkTo': compacted[key]['linkTo'],
+                    'hitRate': rates[key],
+                    'dropped': drop,
+                }) for key in frequent), reportout, indent=2, sort_keys=True)
+        if drop:
+            for key in frequent:
+                del compacted[key]
+            logging.info("Dropped them, %d patterns left" % len(compacted))
+    for key in sorted(compacted):
+        outdb.add('infolisPattern', key, compacted[key])
+    outdb.close()
+
+def iter_solr_docs(darafiles):
+    """
+    Yield (<doc> element source, bytes read so far) for every <doc> in the
+    solr XML responses `darafiles`, without building a tree of a whole
+    response
+    """
+    done = 0
+    for darafile in darafiles:
+        with open(darafile, 'rb') as xmlin:
+            buf = ''
+            for block in iter(lambda: xmlin.read(1 << 20), ''):
+                buf += block
+                pos = 0
+                while True:
+                    start = SOLR_DOC_START_RE.search(buf, pos)
+                    if start is None:
+                        # keep what could be the start of a split start tag
+                        buf = buf[max(pos, len(buf) - len('<doc')):]
+                        break
+                    end = SOLR_DOC_END_RE.search(buf, start.start())
+                    if end is None:
+                        buf = buf[start.start():]
+                        break
+                    yield buf[start.start():end.end()], done + xmlin.tell()
+                    pos = end.end()
+            done += xmlin.tell()
+
+def parse_solr_docs(batch):
+    """
+    Make entities from a list of <doc> element sources, in a worker process
+    """
+    return [make_entity_from_solr_doc(None, ET.fromstring(doc)) for doc in batch]
+
+def iter_solr_entities(darafiles, jobs=1):
+    """
+    Yield (entity or None, bytes read so far) for every <doc> in the
+    `darafiles`.
+
+    With `jobs` > 1, batches of docs are parsed by worker processes.
+    """
+    if jobs <= 1:
+        for doc, offset in iter_solr_docs(darafiles):
+            yield make_entity_from_solr_doc(None, ET.fromstring(doc)), offset
+        return
+    def batches():
+        batch = []
+        for doc, offset in iter_solr_docs(darafiles):
+            batch.append(doc)
+            if len(batch) == SOLR_DOCS_PER_BATCH:
+                yield batch, offset
+                batch = []
+        if batch:
+            yield batch, offset
+    # the pool reads its tasks as fast as it can, limit how many batches
+    # are read ahead of the results
+    window = threading.Semaphore(jobs * 4)
+    stopping = []
+    offsets = deque()
+    def docs():
+        for batch, offset in batches():
+            window.acquire()
+            if stopping:
+                return
+            offsets.append(offset)
+            yield batch
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for entities in pool.imap(parse_solr_docs, docs()):
+            window.release()
+            offset = offsets.popleft()
+            for entity in entities:
+                yield entity, offset
+        pool.close()
+    finally:
+        stopping.append(True)
+        window.release()
+        pool.terminate()
+        pool.join()
+
+def jsonify_dara(darafile, outdbfile, jobs=1):
+    size = os.path.getsize(darafile)
+    # estimate the number of docs from how far into the file we are
+    write_dara_db(iter_solr_entities([darafile], jobs), outdbfile,
+            lambda cur, offset: max(cur + 1, cur * size / max(1, offset)))
+
+def write_dara_db(entities, outdbfile, estimate):
+    """
+    Write the (entity or None, bytes read so far) `entities` and their
+    patterns to `outdbfile`, `estimate(docs, bytes read so far)` being the
+    number of docs to expect
+    """
+    outdb = JsonDbWriter(outdbfile)
+    # patterns stay in memory: make_pattern may add to any of them later on
+    db = { "infolisPattern": {} }
+    cur = 0
+    found = 0
+    t0 = time.time()
+    for entity, offset in METRICS.iter_stage('parse', entities):
+        if entity:
+            with METRICS.stage('write'):
+                outdb.add('entity', entity['_id'], entity)
+            with METRICS.stage('patterns'):
+                found += make_pattern(db, 'darapat', entity['name'], entity['_id'])
+                if '_doi' in entity and entity['_doi'] != None:
+                    found += make_pattern(db, 'darapat', entity['_doi'], entity['_id'])
+        cur += 1
+        print_progress(cur, estimate(cur, offset), found, t0, 'import-dara')
+    print_progress(cur, cur, found, t0, 'import-dara')
+    with METRICS.stage('write'):
+        for key, pattern in db['infolisPattern'].iteritems():
+            outdb.add('infolisPattern', key, pattern)
+        outdb.close()
+
+def jsonify_databases(infile, outfile):
+    """
+    Transform the Google Docs Table CSV to a json-import-able structure
+    """
+    db = { "entity": {}, "infolisPattern": {}, 'entityLink': {} }
+    with io.open(infile, 'r', encoding='utf8') as csvfile:
+        total = len(list(csv.reader(open(infile))))
+        csvreader = csv.reader(csvfile)
+        next(csvreader, None)
+        cur = 0
+        found = 0
+        t0 = time.time()
+        for row in csvreader:
+            cur += 1
+            _id = row[DATABASES_CSV_HEADER['ID']]
+            title = row[DATABASES_CSV_HEADER['TITLE']]
+            url = row[DATABASES_CSV_HEADER['URL']]
+            keywords = row[DATABASES_CSV_HEADER['KEYWORDS']].split(" ; ")
+            db['entity'][_id] = {
+                "entityType": 'database',
+                "url": url,
+                "identifier": url,
+                "name": title
+            }
+            found += make_pattern(db, 'dbpat', title, _id)
+            for pat in keywords:
+                if pat != '':
+                    found += make_pattern(db, 'dbpat', pat, _id)
+            print_progress(cur, total, found, t0, 'import-db')
+        with open(outfile, mode="w") as jsonfile:
+            jsonfile.write(json.dumps(db, indent=2))
+
+def jsonify_icpsr_studies(infile, outfile):
+    with open(infile, 'r') as csvfile:
+        total = len(list(csv.reader(open(infile))))
+        csvreader = csv.reader(csvfile)
+        next(csvreader, None)
+        write_icpsr_studies_db(csvreader, outfile, lambda cur: total)
+
+def write_icpsr_studies_db(rows, outfile, estimate):
+    """
+    Write the studies of the ICPSR CSV `rows` and their patterns to
+    `outfile`, `estimate(rows)` being the number of rows to expect
+    """
+    db = { "entity": {}, "infolisPattern": {}, "entityLink": {} }
+    cur = 0
+    found = 0
+    t0 = time.time()
+    for row in rows:
+        _id = "icpsr_" + row[ICPSRSTUDIES_CSV_HEADER['STUDY_NUMBER']]
+        title = row[ICPSRSTUDIES_CSV_HEADER['TITLE']]
+        doi = row[ICPSRSTUDIES_CSV_HEADER['DOI']]
+        db['entity'][_id] = {
+            'name': title,
+            'entityType': 'dataset',
+            'identifier': doi }
+        found += make_pattern(db, 'icpsrpat', title, _id)
+        found += make_pattern(db, 'icpsrpat', doi, _id)
+        cur += 1
+        print_progress(cur, estimate(cur), found, t0, 'import-icpsr')
+    with open(outfile, mode="w") as jsonfile:
+        jsonfile.write(json.dumps(db, indent=2, encoding='latin1'))
+
+def iter_csv_pages(pagefiles):
+    """
+    Yield the rows of the CSV files `pagefiles`, without the header row of
+    each and blank lines
+    """
+    for pagefile in pagefiles:
+        with open(pagefile, 'rb') as csvfile:
+            csvreader = csv.reader(csvfile)
+            next(csvreader, None)
+            for row in csvreader:
+                if row:
+                    yield row
+
+def harvest(source, pagedir, outfile, url=None, rows=HARVEST_ROWS, threads=HARVEST_THREADS,
+        resume=False, jobs=1):
+    """
+    Download the pages of `source`, 'dara' or 'icpsr', to `pagedir` with a
+    Harvester and convert them to `outfile` as they come in, like
+    jsonify-dara or jsonify-icpsr-studies
+    """
+    harvester = Harvester(source, pagedir, url, rows, threads, resume)
+    if source == 'dara':
+        write_dara_db(iter_solr_entities(harvester, jobs), outfile,
+                lambda cur, offset: max(cur + 1, harvester.total or 0))
+    else:
+        # the number of studies is only known after the last page
+        write_icpsr_studies_db(iter_csv_pages(harvester), outfile,
+                lambda cur: max(cur + 1, (harvester.end or 0) * rows))
+    logging.info("Harvested %d pages of %s to %s" % (harvester.end, source, outfile))
+
+def upload(dbfile, url=UPLOAD_URL, batch_size=UPLOAD_BATCH_SIZE, threads=UPLOAD_THREADS,
+        checkpointfile=None, resume=False):
+    """
+    Send the entities and links of `dbfile` to the InfoLis backend with an
+    Uploader
+    """
+    Uploader(dbfile, url, batch_size, threads, checkpointfile, resume).run()
+
+# http://stackoverflow.com/a/15836901/201318
+class MergeError(Exception):
+    pass
+def data_merge(a, b):
+    """merges b into a and return merged result
+
+    NOTE: tuples and arbitrary objects are not handled as it is totally ambiguous what should happen"""
+    key = None
+    # ## debug output
+    # sys.stderr.write("DEBUG: %s to %s\n" %(b,a))
+    try:
+        if a is None or isinstance(a, str) or isinstance(a, unicode) or isinstance(a, int) or isinstance(a, long) or isinstance(a, float):
+            # border case for first run or if a is a primitive
+            a = b
+        elif isinstance(a, list):
+            # lists can be only appended, without repeating members
+            if not isinstance(b, list):
+                b = [b]
+            for item in b:
+                if item not in a:
+                    a.append(item)
+        elif isinstance(a, dict):
+            # dicts must be merged
+            if isinstance(b, dict):
+                for key in b:
+                    if key in a:
+                        a[key] = data_merge(a[key], b[key])
+                    else:
+                        a[key] = b[key]
+            else:
+                raise MergeError('Cannot merge non-dict "%s" into dict "%s"' % (b, a))
+        else:
+            raise MergeError('NOT IMPLEMENTED "%s" into "%s"' % (b, a))
+    except TypeError, e:
+        raise MergeError('TypeError "%s" in key "%s" when merging "%s" into "%s"' % (e, key, b, a))
+    return a
+
+def write_sorted_runs(args):
+    """
+    Split the entries of one merge-json input into files of
+    MERGE_RUN_SIZE entries sorted by (section, key), return their names
+    and the names of the sections in the input
+    """
+    input_no, path, tmpdir = args
+    sections = []
+    runs = []
+    entries = []
+    def write_run():
+        entries.sort()
+        runfile = os.path.join(tmpdir, 'run-%d-%d' % (input_no, len(runs)))
+        with open(runfile, 'w') as runout:
+            for entry in entries:
+                runout.write(json.dumps(entry) + "\n")
+        runs.append(runfile)
+        del entries[:]
+    for seq, (section, key, value) in enumerate(iter_db_entries(path, sections)):
+        entries.append((section, key, input_no, seq, value))
+        if len(entries) >= MERGE_RUN_SIZE:
+            write_run()
+    if entries:
+        write_run()
+    logging.debug("Split %s into %d sorted runs" % (path, len(runs)))
+    return runs, sections
+
+def iter_run(runfile):
+    with open(runfile) as runin:
+        for line in runin:
+            yield json.loads(line)
+
+def merge_json(outname, innames, jobs=1, tmpdir=None):
+    """
+    Merge JSON dbs with `data_merge` semantics, entry by entry.
+
+    The entries of each input are written to sorted runs on disk, by
+    `jobs` worker processes, and the runs are then merged, so only one
+    run per worker and one entry per run are in memory at a time. Within
+    one input the last value of a key wins, as it would in `json.load`.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='merge-json-', dir=tmpdir)
+    try:
+        tasks = [(input_no, inname, tmpdir) for input_no, inname in enumerate(innames)]
+        if jobs <= 1:
+            results = map(write_sorted_runs, tasks)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(write_sorted_runs, tasks)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        runs = []
+        sections = []
+        for input_runs, input_sections in results:
+            runs.extend(input_runs)
+            sections.extend(section for section in input_sections if section not in sections)
+        logging.debug("Merging %d sorted runs into %s" % (len(runs), outname))
+        outdb = JsonDbWriter(outname, sections)
+        merged = heapq.merge(*[iter_run(runfile) for runfile in runs])
+        for (section, key), entries in itertools.groupby(merged, lambda entry: entry[:2]):
+            # within one input the last value wins, across inputs they are merged
+            values = [list(input_entries)[-1][4] for input_no, input_entries
+                    in itertools.groupby(entries, lambda entry: entry[2])]
+            value = values[0]
+            for other in values[1:]:
+                value = data_merge(value, other)
+            outdb.add(section, key, value)
+        outdb.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+#}}}
+
+
+#-----------------------------------------------------------------------------
+# Main
+#{{{ 
+
+def print_usage(exit_code):
+    prog = sys.argv[0]
+    print("Usage: " + prog + " <command> [args...]")
+    print("""
+    Every command takes
+
+        --metrics <file>    Write the time spent per stage, peak memory,
+                            pattern hit counts and slowest files to
+                            <file> as JSON
+
+    Commands:
+
+    jsonify-databases <csv> <out-json>
+        Convert Databases CSV <csv> to JSON
+
+    jsonify-dara [--jobs N] <solr-xml> <out-json>
+        Convert da-ra solr xml to JSON, with N worker processes
 
     jsonify-icpsr-studies <csv> <out-json>
         Convert ICPSR studies CSV to JSON
 
-    merge-json <outjson> <in1> <in2...>
-        Merges JSON files to be uploaded or used for search
+    harvest [options] dara|icpsr <pagedir> <out-json>
+        Download the da-ra solr docs or the ICPSR studies CSV page by
+        page to <pagedir> and convert them to JSON like jsonify-dara
+        or jsonify-icpsr-studies while later pages are downloading.
+        A request that fails is tried again, up to %d times. Complete
+        pages are recorded in <pagedir>/harvest.manifest.
+
+        --url <url>         Download the pages from <url>, in which
+                            {start} and {rows} are replaced by the first
+                            record and the number of records of a page
+        --rows N            Records per page (default: %d)
+        --threads N         Download N pages at once, each thread over
+                            one HTTP connection it keeps open
+                            (default: %d)
+        --resume            Do not download the pages the manifest
+                            records again
+        --jobs N            dara: parse with N worker processes
 
-    search-patterns <db> <textdir> <metadir> <outdb>
-        Run all the patterns from <db> on the files in <textdir>
-        and create entities from the data <metadir> and link
-        them to the pattern-generating entities and write to <outdb>
-    """)
+    merge-json [--jobs N] [--tmpdir <dir>] <outjson> <in1> <in2...>
+        Merges JSON (or NDJSON) files to be uploaded or used for
+        search, in bounded memory using sorted runs in <dir>,
+        read by N worker processes
+
+    upload [options] <db>
+        POST the entities and links of <db> (JSON or NDJSON, like
+        the output of merge-json or search-patterns) to the InfoLis
+        backend in batches, each a JSON db of its own, each _id
+        once, and report the throughput. A request that fails is
+        tried again, up to %d times. The batches sent are recorded
+        in <db>.upload.
+
+        --url <url>         POST to <url> (default: %s)
+        --batch-size N      Entries per batch (default: %d)
+        --threads N         Send N batches at once, over as many HTTP
+                            connections kept open (default: %d)
+        --checkpoint <file> Record the batches sent in <file>
+        --resume            Do not send the batches the checkpoint
+                            records again
+
+    serve [--socket <path> | --host <host>] [--port N] <db>
+        Load the patterns from <db> (JSON or pattern index, or a
+        comma-separated list) once and answer documents with the
+        entities and links search-patterns would write for them,
+        per <db>. Listens for HTTP on %s:%d by default: POST a
+        document as text/plain or JSON lines of
+        {"text": ..., "meta": <OAI-PMH XML>, "id": ...}, 'meta' and
+        'id' optional. With --socket, reads such JSON lines, or
+        lists of them, from the Unix socket <path> instead.
+
+    merge-shards <outdb> <shard-outdb1> <shard-outdb2...>
+        Combine the outputs of all shards of a search-patterns
+        --shard run into <outdb>, which is then the same as the
+        output of a run without --shard
+
+    finalize-ndjson <in-ndjson> <outdb>
+        Convert the NDJSON output of search-patterns to a JSON db
+
+    summarize [--top N] [--by-pattern] <outdb...>
+        Print the number of links of the outputs of search-patterns,
+        in total, per corpus, per pattern and per target entity, the
+        N (default: %d) most frequent patterns and targets and a
+        histogram of the confidences. Reads <outdb>.summary.json
+        where search-patterns wrote it, the output otherwise, the
+        corpus of which is '%s'.
+
+        --by-pattern        Only print the count per pattern, most
+                            frequent last
+
+    rescore [options] <outdb> <new-outdb>
+        Write the links of <outdb> to <new-outdb> with confidences
+        computed anew from the hit matrix search-patterns
+        --hit-matrix wrote with it, without reading any text. Needs
+        NumPy.
+
+        --weight W          'split': 1/n for a pattern linking to n
+                            entities (default), 'idf': that times
+                            log(files / files with the pattern) /
+                            log(files)
+        --min-confidence C  Drop links with a lower confidence
+        --max-df R          Drop the patterns found in more than the
+                            share R of the files
+        --min-patterns K    Drop links made by fewer than K patterns
+
+    diff-patterns <old-db> <new-db> <delta>
+        Write the patterns added, removed and changed from <old-db>
+        to <new-db> to <delta>, for search-patterns --delta
+
+    compile-patterns <db> <index>
+        Compile the patterns from <db> to a pattern index that
+        search-patterns loads much faster than the JSON, and store
+        the entities of <db> in <index>.entities
+
+    compact-patterns [options] <db> <out-json>
+        Merge the patterns in <db> that match the same string up
+        to whitespace into one linking to all their entities
+
+        --fold-case         Also merge strings that differ in case only,
+                            keeping the spelling of the first
+        --sample <textdir>  Measure how many files of a sample of the
+                            corpus <textdir> (directory or packed
+                            corpus) each pattern is found in
+        --sample-size N     Files in the sample (default: 1000)
+        --max-hit-rate R    Report the patterns found in more than
+                            this share of the sample (default: 0.05)
+        --drop              Drop the reported patterns
+        --report <file>     Write the reported patterns to <file>
+
+    pack-corpus <textdir> <packfile>
+        Pack the text files in <textdir> into <packfile> and
+        <packfile>.index, for search-patterns to scan repeatedly
+
+    index-metadata <metadir> [<store>]
+        Parse the OAI-PMH XML files in <metadir> (directory or
+        archive) once and store the
+        entities in <store> (default: <metadir>.store), which
+        search-patterns can use instead of <metadir>
+
+    index-corpus [--tmpdir <dir>] <textdir> <index>
+        Index the words of the files in <textdir> (directory or
+        packed corpus) in <index>, <index>.index and <index>.files,
+        using sorted runs in <dir>, for query-patterns
+
+    query-patterns <db> <index> <metadir> <outdb>
+        Like search-patterns, but only read the files in which
+        <index> (see index-corpus) has the words of a pattern, one
+        right after the other. <db> and <outdb> can be
+        comma-separated lists.
+
+    search-patterns [options] <db> <textdir> <metadir> <outdb>
+        Run all the patterns from <db> (JSON or pattern index) on
+        the files in <textdir> (directory, packed corpus or archive)
+        and create entities from the data in <metadir> (directory,
+        archive or index-metadata store) and link them to the
+        pattern-generating entities and write to <outdb>. If <outdb> ends in .ndjson or
+        .ndjson.gz, entities and links are streamed to it as they
+        are found, see finalize-ndjson. The link counts summarize
+        prints are written to <outdb>.summary.json.
+
+        An archive is a .tar, .tar.gz, .tgz, .tar.bz2, .gz (a
+        compressed tar) or .zip file, read without unpacking it. The
+        *.txt files in a text archive are paired with the *.xml files
+        of the same name in a metadata archive. A compressed tar is
+        read from start to end, once per --jobs process.
+
+        Several pattern sets can be searched in one pass over the
+        files with <db> and <outdb> as comma-separated lists:
+        the links for the n-th <db> are written to the n-th <outdb>.
+
+        --jobs N            Search with N worker processes
+        --manifest <file>   Record searched files and results in <file>
+                            (default: <outdb>.manifest, for the
+                            first <outdb>)
+        --resume            Only search files that are new, changed or
+                            not yet searched with these patterns
+                            according to the manifest
+        --prefetch N        Read text and metadata files ahead with N
+                            threads (per worker process) while
+                            searching, for slow (network) filesystems
+        --queue-depth D     Hold at most D files read ahead (default:
+                            %d per --prefetch thread)
+        --include-targets   Also write the entities of <db> that the
+                            links point to, read from the store
+                            compile-patterns writes to <index>.entities
+        --delta <delta>     Update the search of the manifest, made with
+                            the old db of <delta> (see diff-patterns),
+                            to <db>, its new db: files unchanged since
+                            are only searched for the added and changed
+                            patterns, the links of the others are
+                            written anew from the manifest
+        --hit-matrix        Also write which patterns were found in which
+                            file to <outdb>.hits.npz, a sparse matrix
+                            NumPy can load, for rescore
+        --max-file-size N   Skip, with a warning, text files larger than N
+                            bytes
+        --max-file-seconds S
+                            Skip, with a warning, text files not searched
+                            after S seconds
+        --shard i/N         Only search the i-th of N parts of the files
+                            (1 <= i <= N), chosen by a hash of their
+                            names, and record in <outdb>.shard what
+                            merge-shards needs to combine the parts
+    """ % (HTTP_RETRIES, HARVEST_ROWS, HARVEST_THREADS, HTTP_RETRIES, UPLOAD_URL,
+        UPLOAD_BATCH_SIZE, UPLOAD_THREADS, SERVE_HOST, SERVE_PORT, SUMMARY_TOP, UNKNOWN_CORPUS,
+        PREFETCH_DEPTH_PER_THREAD))
     sys.exit(exit_code)
 
 if __name__ == "__main__":
@@ -457,35 +4058,200 @@ if __name__ == "__main__":
     if len(sys.argv) < 2 or sys.argv[1] == '-h' or sys.argv[1] == '--help':
         print_usage(0)
     cmd = sys.argv[1]
+    metricsfile = None
+    if '--metrics' in sys.argv[2:]:
+        idx = sys.argv.index('--metrics', 2)
+        if idx + 1 == len(sys.argv):
+            print_usage(1)
+        metricsfile = sys.argv[idx + 1]
+        del sys.argv[idx:idx + 2]
+        METRICS.enable()
     if cmd == 'jsonify-databases':
         if len(sys.argv) != 4:
             print_usage(1)
         jsonify_databases(sys.argv[2], sys.argv[3])
     elif cmd == 'jsonify-dara':
-        if len(sys.argv) != 4:
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['jobs='])
+            jobs = int(dict(opts).get('--jobs', 1))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
             print_usage(1)
-        jsonify_dara(sys.argv[2], sys.argv[3])
+        if len(args) != 2:
+            print_usage(1)
+        jsonify_dara(args[0], args[1], jobs)
     elif cmd == 'jsonify-icpsr-studies':
         if len(sys.argv) != 4:
             print_usage(1)
         jsonify_icpsr_studies(sys.argv[2], sys.argv[3])
+    elif cmd == 'harvest':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['url=', 'rows=', 'threads=',
+                'resume', 'jobs='])
+            opts = dict(opts)
+            rows = int(opts.get('--rows', HARVEST_ROWS))
+            threads = int(opts.get('--threads', HARVEST_THREADS))
+            jobs = int(opts.get('--jobs', 1))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 3 or args[0] not in HARVEST_SOURCES or rows < 1 or threads < 1:
+            print_usage(1)
+        try:
+            harvest(args[0], args[1], args[2], opts.get('--url'), rows, threads,
+                    '--resume' in opts, jobs)
+        except HttpError, e:
+            logging.error("%s, run again with --resume to continue" % e)
+            sys.exit(1)
+    elif cmd == 'serve':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['socket=', 'host=', 'port='])
+            opts = dict(opts)
+            port = int(opts.get('--port', SERVE_PORT))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 1:
+            print_usage(1)
+        serve(args[0].split(','), opts.get('--socket'), opts.get('--host', SERVE_HOST), port)
+    elif cmd == 'merge-shards':
+        if len(sys.argv) < 4:
+            print_usage(1)
+        try:
+            merge_shards(sys.argv[2], sys.argv[3:])
+        except ShardError, e:
+            logging.error(e)
+            sys.exit(1)
+    elif cmd == 'finalize-ndjson':
+        if len(sys.argv) != 4:
+            print_usage(1)
+        finalize_ndjson(sys.argv[2], sys.argv[3])
+    elif cmd == 'summarize':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['top=', 'by-pattern'])
+            opts = dict(opts)
+            top = int(opts.get('--top', SUMMARY_TOP))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if not args:
+            print_usage(1)
+        summarize(args, top, '--by-pattern' in opts)
+    elif cmd == 'rescore':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', [
+                'weight=', 'min-confidence=', 'max-df=', 'min-patterns='])
+            opts = dict(opts)
+            min_confidence = float(opts.get('--min-confidence', 0))
+            max_df = float(opts['--max-df']) if '--max-df' in opts else None
+            min_patterns = int(opts.get('--min-patterns', 1))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 2 or opts.get('--weight', 'split') not in ('split', 'idf'):
+            print_usage(1)
+        if numpy is None:
+            logging.error("rescore needs NumPy")
+            sys.exit(1)
+        rescore(args[0], args[1], opts.get('--weight', 'split'), min_confidence, max_df, min_patterns)
+    elif cmd == 'diff-patterns':
+        if len(sys.argv) != 5:
+            print_usage(1)
+        diff_patterns(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif cmd == 'compile-patterns':
+        if len(sys.argv) != 4:
+            print_usage(1)
+        compile_patterns(sys.argv[2], sys.argv[3])
+    elif cmd == 'compact-patterns':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['fold-case', 'sample=',
+                'sample-size=', 'max-hit-rate=', 'drop', 'report='])
+            opts = dict(opts)
+            sample_size = int(opts.get('--sample-size', 1000))
+            max_hit_rate = float(opts.get('--max-hit-rate', 0.05))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 2:
+            print_usage(1)
+        compact_patterns(args[0], args[1], '--fold-case' in opts, opts.get('--sample'),
+                sample_size, max_hit_rate, '--drop' in opts, opts.get('--report'))
+    elif cmd == 'pack-corpus':
+        if len(sys.argv) != 4:
+            print_usage(1)
+        pack_corpus(sys.argv[2], sys.argv[3])
+    elif cmd == 'index-metadata':
+        if len(sys.argv) not in (3, 4):
+            print_usage(1)
+        metadir = sys.argv[2].rstrip('/')
+        index_metadata(metadir, sys.argv[3] if len(sys.argv) == 4 else metadir + '.store')
+    elif cmd == 'index-corpus':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['tmpdir='])
+        except getopt.GetoptError, e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 2:
+            print_usage(1)
+        index_corpus(args[0].rstrip('/'), args[1], dict(opts).get('--tmpdir'))
+    elif cmd == 'query-patterns':
+        if len(sys.argv) != 6 or len(sys.argv[2].split(',')) != len(sys.argv[5].split(',')):
+            print_usage(1)
+        query_patterns(sys.argv[2].split(','), sys.argv[3], sys.argv[4], sys.argv[5].split(','))
     elif cmd == 'search-patterns':
-        if len(sys.argv) != 6:
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['jobs=', 'manifest=', 'resume',
+                'prefetch=', 'queue-depth=', 'include-targets', 'shard=', 'delta=', 'hit-matrix',
+                'max-file-size=', 'max-file-seconds='])
+            opts = dict(opts)
+            jobs = int(opts.get('--jobs', 1))
+            prefetch = int(opts.get('--prefetch', 0))
+            queue_depth = int(opts.get('--queue-depth', 0)) or None
+            shard = parse_shard(opts['--shard']) if '--shard' in opts else None
+            FILE_BUDGET['bytes'] = int(opts.get('--max-file-size', 0))
+            FILE_BUDGET['seconds'] = float(opts.get('--max-file-seconds', 0))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
             print_usage(1)
-        search_patterns(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+        if len(args) != 4 or len(args[0].split(',')) != len(args[3].split(',')):
+            print_usage(1)
+        if '--delta' in opts and len(args[0].split(',')) != 1:
+            logging.error("--delta works with one <db> only")
+            print_usage(1)
+        search_patterns(args[0].split(','), args[1], args[2], args[3].split(','), jobs,
+                opts.get('--manifest'), '--resume' in opts, prefetch, queue_depth,
+                '--include-targets' in opts, shard, opts.get('--delta'), '--hit-matrix' in opts)
     elif cmd == 'merge-json':
-        if len(sys.argv) < 5:
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['jobs=', 'tmpdir='])
+            opts = dict(opts)
+            jobs = int(opts.get('--jobs', 1))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) < 3:
             print_usage(1)
-        outname = sys.argv[2]
-        outjson = {}
-        for inname in sys.argv[3:]:
-            with open(inname, 'r') as infile:
-                logging.debug('Merging %s' % inname)
-                injson = json.load(infile)
-                outjson = data_merge(outjson, injson)
-        with open(outname, 'w') as outfile:
-            logging.debug("Writing to %s" % outname)
-            json.dump(outjson, outfile)
+        merge_json(args[0], args[1:], jobs, opts.get('--tmpdir'))
+    elif cmd == 'upload':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['url=', 'batch-size=', 'threads=',
+                'checkpoint=', 'resume'])
+            opts = dict(opts)
+            batch_size = int(opts.get('--batch-size', UPLOAD_BATCH_SIZE))
+            threads = int(opts.get('--threads', UPLOAD_THREADS))
+        except (getopt.GetoptError, ValueError), e:
+            logging.error(e)
+            print_usage(1)
+        if len(args) != 1 or batch_size < 1 or threads < 1:
+            print_usage(1)
+        try:
+            upload(args[0], opts.get('--url', UPLOAD_URL), batch_size, threads,
+                    opts.get('--checkpoint'), '--resume' in opts)
+        except HttpError, e:
+            logging.error("%s, run again with --resume to continue" % e)
+            sys.exit(1)
     else:
         print_usage(1)
+    if metricsfile:
+        METRICS.save(metricsfile)
 #}}}
@@ -25,9 +25,10 @@ timestamp() {
 }
 
 usage () {
-    echo "$(basename $0) <patternset> [dataset...]
+    echo "$(basename $0) <patternset>[,<patternset>...] [dataset...]
 
         Patternsets: ${!patternsets[*]}
+        Several comma-separated patternsets are searched in one pass.
 
         Datasets: ${!dataset_names[*]}
 
@@ -36,13 +37,20 @@ usage () {
 }
 
 main () {
-    declare -a datasets
-    patternset="$1"; shift;
-    if [[ -z "$patternset" || -z "${patternsets[$patternset]}" ]];then
-        echo "no such patternset '$patternset'"
+    declare -a datasets sets
+    IFS=',' read -ra sets <<< "$1"; shift;
+    if [[ ${#sets[@]} == 0 ]];then
         usage
         exit 1
     fi
+    local patternset
+    for patternset in "${sets[@]}";do
+        if [[ -z "${patternsets[$patternset]}" ]];then
+            echo "no such patternset '$patternset'"
+            usage
+            exit 1
+        fi
+    done
     if [[ -z "$1" ]];then
         datasets=("${!dataset_names[@]}")
     else
@@ -56,12 +64,21 @@ main () {
             exit 2
         fi
     done
-    local dataset textdir metadir outfile
+    local dataset textdir metadir dbs outfiles
     for dataset in "${datasets[@]}";do
         textdir="${dataset_names[$dataset]}"
         metadir="${filemeta[$textdir]}"
-        outfile="output-${dataset}-${patternset}-$(timestamp).json"
-        ./dbminer.py search-patterns "${patternsets[$patternset]}" "$textdir" "$metadir" "$outfile"
+        # prefer metadata prepared with 'dbminer.py index-metadata'
+        if [[ -f "$metadir.store" ]];then
+            metadir="$metadir.store"
+        fi
+        dbs=()
+        outfiles=()
+        for patternset in "${sets[@]}";do
+            dbs+=("${patternsets[$patternset]}")
+            outfiles+=("output-${dataset}-${patternset}-$(timestamp).json")
+        done
+        ./dbminer.py search-patterns "$(IFS=,; echo "${dbs[*]}")" "$textdir" "$metadir" "$(IFS=,; echo "${outfiles[*]}")"
     done
 }
 
@@ -1,2 +1,3 @@
 #!/bin/bash
-grep -h "linkReason" "$@"|sort|uniq -c|sort -h
+# Links per pattern in search-patterns outputs, most frequent last
+exec "$(dirname "$0")/dbminer.py" summarize --by-pattern "$@"